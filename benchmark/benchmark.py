@@ -0,0 +1,183 @@
+"""
+Benchmark of every stage of the sheet compiling pipeline, using synthetic sheets
+
+Usage: python benchmark/benchmark.py [-o benchmark.json] [--segments 256 1024] [--tracks 1 4] ...
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from typing import List, Callable, Any, Dict, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from item import ShulkerSheetStorage
+from main import VERSION
+from sheet import Sheet, RhythmMode
+
+SEGMENTS_PER_LINE = 16
+NOTES = ['1', '2', '3', '4', '5', '6', '7', '#1', '#4', 'b7', "1'", "3'", '5,', '6,']
+
+
+def generate_sheet(segment_amount: int, track_amount: int, rhythm_mode: RhythmMode, density: float, seed: int = 0) -> str:
+	"""
+	Generate a random sheet
+	:param density: the chance of a symbol to be a note instead of a 0
+	"""
+	rnd = random.Random(seed)
+	lines = [rhythm_mode.value, '1=C', '']
+	for start in range(0, segment_amount, SEGMENTS_PER_LINE):
+		for _ in range(track_amount):
+			segments = []
+			for _ in range(min(SEGMENTS_PER_LINE, segment_amount - start)):
+				symbols = []
+				for i in range(rnd.choice([1, 2, 4])):
+					if rnd.random() >= density:
+						symbols.append('0')
+					elif rhythm_mode == RhythmMode.long_tone and rnd.random() < 0.2:
+						symbols.append('-')
+					else:
+						symbols.append(rnd.choice(NOTES))
+				if symbols[0] == '-' and start == 0 and len(segments) == 0:
+					symbols[0] = '1'
+				segments.append(''.join(symbols))
+			lines.append('| {} |'.format(' '.join(segments)))
+		lines.append('')
+	return '\n'.join(lines)
+
+
+class _NullWriter:
+	def write(self, message: str):
+		pass
+
+	def flush(self):
+		pass
+
+
+def run_pipeline(content: str, measure: Callable[[str, Callable[[], Any]], Any]) -> Dict[str, int]:
+	"""
+	Run the pipeline, measuring each stage with the given measure function
+	:return: the output size figures
+	"""
+	sheet = measure('Sheet.load', lambda: Sheet.load(content))
+	measure('Sheet.process_data', sheet.process_data)
+	measure('Sheet.process_time_mark', sheet.process_time_mark)
+
+	def fill_storages() -> List[ShulkerSheetStorage]:
+		storages = []
+		for i, track in enumerate(sheet.red_tracks):
+			storage_symbol = ShulkerSheetStorage('音轨#{}音符序列'.format(i + 1))
+			storage_time_mark = ShulkerSheetStorage('音轨#{}节奏序列'.format(i + 1))
+			for track_item, length in track.iter_runs():
+				items = track_item.to_items()
+				storage_symbol.add_item_run(items[0], length)
+				storage_time_mark.add_item_run(items[1], length)
+			storages.extend([storage_symbol, storage_time_mark])
+		return storages
+
+	storages = measure('ShulkerSheetStorage.add_item_run', fill_storages)
+	builds = measure('ShulkerSheetStorage.build', lambda: [storage.build() for storage in storages])
+	shulker_commands = measure('StorageBuild.get_give_commands', lambda: [cmd for build in builds for cmd in build.get_give_commands()])
+	chest_commands = measure('StorageBuild.get_chest_commands', lambda: [cmd for build in builds for cmd in build.get_chest_commands()])
+	return {
+		'red_tracks': len(sheet.red_tracks),
+		'shulkers': len(shulker_commands),
+		'chest_commands': len(chest_commands),
+		'chest_command_chars': sum(map(len, chest_commands)),
+	}
+
+
+def benchmark_case(content: str, segment_amount: int, repeat: int) -> Dict[str, Any]:
+	stage_costs: Dict[str, List[float]] = {}
+	stage_peaks: Dict[str, int] = {}
+
+	def measure_time(stage: str, func: Callable[[], Any]):
+		start = time.perf_counter()
+		ret = func()
+		stage_costs.setdefault(stage, []).append(time.perf_counter() - start)
+		return ret
+
+	def measure_memory(stage: str, func: Callable[[], Any]):
+		# restart tracing for each stage, so only the blocks allocated by the stage are traced.
+		# tracemalloc.reset_peak() would do, but it needs python 3.9+
+		tracemalloc.start()
+		try:
+			ret = func()
+			stage_peaks[stage] = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+		return ret
+
+	with contextlib.redirect_stdout(_NullWriter()):
+		sizes = {}
+		for _ in range(repeat):
+			sizes = run_pipeline(content, measure_time)
+		# memory is measured in a separated run, since tracemalloc slows everything down
+		run_pipeline(content, measure_memory)
+
+	stages = {}
+	for stage, costs in stage_costs.items():
+		best = min(costs)
+		stages[stage] = {
+			'best_seconds': best,
+			'mean_seconds': sum(costs) / len(costs),
+			'segments_per_second': segment_amount / best if best > 0 else None,
+			'peak_memory_bytes': stage_peaks.get(stage),
+		}
+	return {
+		'total_best_seconds': sum(stage['best_seconds'] for stage in stages.values()),
+		'stages': stages,
+		'output': sizes,
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark every stage of the RedPiano pipeline with synthetic sheets')
+	parser.add_argument('-o', '--output', default='benchmark.json', help='The json file to store the result. Default: benchmark.json')
+	parser.add_argument('--segments', type=int, nargs='+', default=[256, 2048], help='Segment amounts of the synthetic sheets')
+	parser.add_argument('--tracks', type=int, nargs='+', default=[1, 4], help='简谱 track amounts of the synthetic sheets')
+	parser.add_argument('--modes', nargs='+', choices=[mode.name for mode in RhythmMode], default=[mode.name for mode in RhythmMode], help='Rhythm modes of the synthetic sheets')
+	parser.add_argument('--density', type=float, nargs='+', default=[0.3, 0.8], help='Note densities of the synthetic sheets')
+	parser.add_argument('--repeat', type=int, default=3, help='Run each case for this many times and keep the best timing. Default: 3')
+	parser.add_argument('--seed', type=int, default=0, help='Random seed of the sheet generator. Default: 0')
+	args = parser.parse_args()
+
+	cases: List[Dict[str, Any]] = []
+	params: List[Tuple[int, int, str, float]] = list(itertools.product(args.segments, args.tracks, args.modes, args.density))
+	for i, (segment_amount, track_amount, mode_name, density) in enumerate(params):
+		content = generate_sheet(segment_amount, track_amount, RhythmMode[mode_name], density, args.seed)
+		result = benchmark_case(content, segment_amount, args.repeat)
+		result['params'] = {
+			'segments': segment_amount,
+			'tracks': track_amount,
+			'rhythm_mode': mode_name,
+			'density': density,
+			'seed': args.seed,
+			'sheet_chars': len(content),
+		}
+		cases.append(result)
+		print('[{}/{}] segments={} tracks={} mode={} density={}: {:.3f}s'.format(i + 1, len(params), segment_amount, track_amount, mode_name, density, result['total_best_seconds']))
+		for stage, data in result['stages'].items():
+			print('  {:<45} {:>9.2f}ms {:>12.0f} seg/s {:>10} bytes peak'.format(stage, data['best_seconds'] * 1000, data['segments_per_second'] or 0, data['peak_memory_bytes']))
+
+	report = {
+		'version': VERSION,
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'timestamp': time.time(),
+		'cases': cases,
+	}
+	with open(args.output, 'w', encoding='utf8') as f:
+		json.dump(report, f, indent=2, ensure_ascii=False)
+	print('Benchmark result saved to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+	main()
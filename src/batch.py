@@ -0,0 +1,231 @@
+import contextlib
+import glob
+import io
+import os
+import sys
+import time
+import traceback
+from typing import List, Optional, NamedTuple, Iterable
+
+import compiler
+import instrument
+import mapping
+from compiler import CompileOptions
+from intermediate import write_intermediate
+from stream import SheetStream
+from structure import StoragePair, export_structure, export_mcfunction, get_structure_origins, get_structure_path
+
+
+class BatchResult(NamedTuple):
+	input_path: str
+	output_path: str
+	cost: float
+	error: Optional[str]
+
+	@property
+	def success(self) -> bool:
+		return self.error is None
+
+
+def collect_sheet_files(patterns: List[str]) -> List[str]:
+	"""
+	Expand the given directories / glob patterns into a sorted list of sheet files without duplication
+	A directory means all *.txt files inside it
+	"""
+	paths: List[str] = []
+	for pattern in patterns:
+		if os.path.isdir(pattern):
+			matched = glob.glob(os.path.join(pattern, '*.txt'))
+		else:
+			matched = glob.glob(pattern)
+		for path in sorted(matched):
+			if os.path.isfile(path) and path not in paths:
+				paths.append(path)
+	# the same file matched with different paths, e.g. a.txt and ./a.txt
+	unique_paths = {}
+	for path in paths:
+		unique_paths.setdefault(os.path.normcase(os.path.realpath(path)), path)
+	return list(unique_paths.values())
+
+
+# export format -> file extension
+EXPORT_FORMATS = {
+	'structure': '.nbt',
+	'mcfunction': '.mcfunction',
+	'intermediate': '.rpi',
+}
+
+
+def export_storages(storages: List[StoragePair], path_base: str, formats: Iterable[str], result: Optional[compiler.CompileResult] = None):
+	"""
+	:param result: the compile result, needed by the intermediate format. Not available in stream mode
+	"""
+	for export_format in formats:
+		path = path_base + EXPORT_FORMATS[export_format]
+		if export_format == 'structure':
+			# large songs are split into several structures, each fits into a structure block
+			origins = get_structure_origins(storages)
+			for origin in origins:
+				structure_path = path if len(origins) == 1 else get_structure_path(path, origin)
+				with replace_atomically(structure_path) as temp_path:
+					export_structure(storages, temp_path, origin)
+				print('已导出至{}'.format(structure_path))
+			continue
+		with replace_atomically(path) as temp_path:
+			if export_format == 'mcfunction':
+				export_mcfunction(storages, temp_path)
+			elif export_format == 'intermediate':
+				if result is None:
+					raise ValueError('The intermediate format cannot be exported in stream mode')
+				write_intermediate(temp_path, result.rhythm_mode, result.noteblock_tracks, result.red_tracks)
+			else:
+				raise ValueError('Unknown export format {}'.format(export_format))
+		print('已导出至{}'.format(path))
+
+
+def compile_sheet(content: str, options: CompileOptions = CompileOptions(), export_path_base: str = 'output'):
+	"""
+	Compile the sheet and print the result. With the cache enabled, the whole output of an unchanged sheet is reused
+	:param export_path_base: the exported files are named export_path_base + extension
+	"""
+	cache = options.create_cache()
+	# exporting needs the storages, so the output cannot be reused
+	if cache is None or len(options.export_formats) > 0:
+		result = compiler.compile_sheet(content, options)
+		sys.stdout.write(result.render())
+		export_storages(result.storages, export_path_base, options.export_formats, result)
+		return
+	key = cache.make_key('output', str(options.compact), content)
+	output = cache.get('output', key)
+	if output is None:
+		output = compiler.compile_sheet(content, options).render()
+		cache.put('output', key, output)
+	sys.stdout.write(output)
+
+
+def compile_sheet_stream(lines: Iterable[str], options: CompileOptions = CompileOptions(), export_path_base: str = 'output'):
+	stream = SheetStream(lines)
+	stream.generate_command(options.create_cache(), options.compact)
+	export_storages(stream.storages, export_path_base, options.export_formats)
+
+
+def get_report_path(output_path: str) -> str:
+	"""
+	The path of the instrumentation report, placed next to the output file
+	"""
+	return os.path.splitext(output_path)[0] + '.report.json'
+
+
+def get_output_paths(input_paths: List[str], output_dir: str) -> List[str]:
+	"""
+	The output path of each input file. The paths of the input files relative to their common directory are kept
+	in the output directory, so input files with the same name in different directories don't overwrite each other
+	:raise ValueError: if any output file, export file or report would overwrite an input file
+	"""
+	if len(input_paths) == 0:
+		return []
+	abs_paths = [os.path.abspath(path) for path in input_paths]
+	try:
+		base_dir = os.path.commonpath([os.path.dirname(path) for path in abs_paths])
+		relative_paths = [os.path.relpath(path, base_dir) for path in abs_paths]
+	except ValueError:
+		# on different drives
+		relative_paths = [os.path.splitdrive(path)[1].lstrip(os.sep) for path in abs_paths]
+	output_paths = [os.path.join(output_dir, path) for path in relative_paths]
+
+	input_files = {os.path.normcase(os.path.realpath(path)) for path in input_paths}
+	for input_path, output_path in zip(input_paths, output_paths):
+		path_base = os.path.splitext(output_path)[0]
+		for path in [output_path, get_report_path(output_path)] + [path_base + extension for extension in EXPORT_FORMATS.values()]:
+			if os.path.normcase(os.path.realpath(path)) in input_files:
+				raise ValueError('输入文件{}的输出文件{}会覆盖输入文件'.format(input_path, path))
+	return output_paths
+
+
+@contextlib.contextmanager
+def replace_atomically(path: str):
+	"""
+	Yield a temporary path next to the target to write into. It replaces the target when the context exits without error,
+	so readers never see a half-written file
+	"""
+	temp_path = '{}.{}.tmp'.format(path, os.getpid())
+	try:
+		yield temp_path
+		os.replace(temp_path, path)
+	finally:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+
+
+def write_file_atomically(path: str, content: str):
+	with replace_atomically(path) as temp_path:
+		with open(temp_path, 'w', encoding='utf8') as f:
+			f.write(content)
+
+
+def compile_sheet_file(input_path: str, output_path: str, options: CompileOptions = CompileOptions()) -> BatchResult:
+	start = time.time()
+	error = None
+	buf = io.StringIO()
+	if options.mapping_file is not None:
+		# worker processes do not inherit the mapping selected in the main process
+		mapping.set_mapping_file(options.mapping_file)
+	instrumentation = instrument.Instrumentation()
+	with contextlib.redirect_stdout(buf), instrument.enable(instrumentation) if options.report else contextlib.nullcontext():
+		try:
+			with open(input_path, encoding='utf8') as f:
+				export_path_base = os.path.splitext(output_path)[0]
+				if options.stream:
+					compile_sheet_stream(f, options, export_path_base)
+				else:
+					compile_sheet(f.read(), options, export_path_base)
+		except:
+			error = traceback.format_exc()
+			print(error)
+	write_file_atomically(output_path, buf.getvalue())
+	if options.report:
+		with replace_atomically(get_report_path(output_path)) as temp_path:
+			instrumentation.save(temp_path)
+	return BatchResult(input_path, output_path, time.time() - start, error)
+
+
+def print_batch_result(result: BatchResult):
+	if result.success:
+		print('[成功] {} -> {} ({:.3f}s)'.format(result.input_path, result.output_path, result.cost))
+	else:
+		print('[失败] {} ({:.3f}s)'.format(result.input_path, result.cost))
+		print('  ' + result.error.rstrip().splitlines()[-1])
+
+
+def run_batch(patterns: List[str], output_dir: str, jobs: Optional[int] = None, options: CompileOptions = CompileOptions()) -> List[BatchResult]:
+	paths = collect_sheet_files(patterns)
+	if len(paths) == 0:
+		print('未找到任何输入文件')
+		return []
+	try:
+		output_paths = get_output_paths(paths, output_dir)
+	except ValueError as e:
+		print(e)
+		return []
+	for output_path in output_paths:
+		os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+	print('批量处理{}个输入文件，输出目录: {}'.format(len(paths), output_dir))
+	start = time.time()
+	results: List[BatchResult] = []
+	# imported here since it's slow to import and only needed in batch mode
+	from concurrent.futures import ProcessPoolExecutor
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		futures = []
+		for path, output_path in zip(paths, output_paths):
+			futures.append((path, output_path, executor.submit(compile_sheet_file, path, output_path, options)))
+		for path, output_path, future in futures:
+			try:
+				result = future.result()
+			except Exception:
+				# the worker itself died, e.g. the process pool is broken
+				result = BatchResult(path, output_path, 0, traceback.format_exc())
+			results.append(result)
+			print_batch_result(result)
+	fail_count = len([result for result in results if not result.success])
+	print('批量处理完成，成功{}个，失败{}个，总耗时{:.3f}s'.format(len(results) - fail_count, fail_count, time.time() - start))
+	return results
@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+from typing import Optional, Any
+
+from mapping import get_mapping
+
+# bump this when the compiled output of the same input changes
+CACHE_VERSION = 3
+
+
+class CompileCache:
+	"""
+	A persistent content-addressed cache of compile results, stored as json files in the given directory
+
+	Entries are keyed by the hash of their inputs together with the cache version and the item mapping,
+	so they never need to be invalidated. There's no eviction, delete the directory to clean it up
+	"""
+	def __init__(self, directory: str):
+		self.directory = directory
+		self.hits = 0
+		self.misses = 0
+		self.__salt = '{}\0{}'.format(CACHE_VERSION, get_mapping().digest)
+
+	def make_key(self, *parts: str) -> str:
+		sha = hashlib.sha256(self.__salt.encode('utf8'))
+		for part in parts:
+			sha.update(b'\0')
+			sha.update(part.encode('utf8'))
+		return sha.hexdigest()
+
+	def __get_path(self, kind: str, key: str) -> str:
+		return os.path.join(self.directory, kind, key[:2], key + '.json')
+
+	def get(self, kind: str, key: str) -> Optional[Any]:
+		try:
+			with open(self.__get_path(kind, key), encoding='utf8') as f:
+				value = json.load(f)
+		except (OSError, ValueError):
+			self.misses += 1
+			return None
+		self.hits += 1
+		return value
+
+	def put(self, kind: str, key: str, value: Any):
+		path = self.__get_path(kind, key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# write to a temp file first, so a half-written entry is never read
+		temp_path = '{}.{}.tmp'.format(path, os.getpid())
+		with open(temp_path, 'w', encoding='utf8') as f:
+			# json.dump encodes in pure python, dumps is much faster with the C encoder
+			f.write(json.dumps(value, ensure_ascii=False))
+		os.replace(temp_path, path)
@@ -0,0 +1,130 @@
+"""
+The library api of RedPiano: compile a sheet into structured results without printing anything
+
+	result = compile_sheet(text, CompileOptions(compact=True))
+	for symbol_commands, time_mark_commands in result.commands:
+		...
+	print(result.render(), end='')
+"""
+import contextlib
+from typing import NamedTuple, Optional, Tuple, List
+
+import mapping
+from cache import CompileCache
+from sheet import Sheet, RhythmMode, NoteBlockSymbolTrack, StorageUsage, StorageCommands, render_storage_commands
+from item import ShulkerSheetStorage
+from track import RedPianoTrack
+
+
+class CompileOptions(NamedTuple):
+	stream: bool = False  # use the streaming pipeline, see SheetStream
+	report: bool = False  # save an instrumentation report next to the output file
+	cache_dir: Optional[str] = None  # enable the compile cache in the given directory
+	export_formats: Tuple[str, ...] = ()  # formats in batch.EXPORT_FORMATS to export the chests to
+	compact: bool = False  # use the compact SNBT encoding in the give commands
+	mapping_file: Optional[str] = None  # use the given item mapping file instead of the default mapping.json
+	parallel: Optional[int] = None  # run the per-track jobs on this many workers, 0 for the cpu count. None to run serially
+
+	def create_cache(self) -> Optional[CompileCache]:
+		return CompileCache(self.cache_dir) if self.cache_dir is not None else None
+
+
+class CompileResult:
+	"""
+	Everything compiled from a sheet. The human-readable output is only formatted when render() is called
+	"""
+	def __init__(self, sheet: Sheet):
+		self.rhythm_mode: RhythmMode = sheet.rhythm_mode
+		self.track_amount: int = len(sheet.segments_list)
+		self.segment_amount: int = sheet.segment_amount
+		# note block symbols of each segment of each 简谱 track
+		self.noteblock_tracks: List[NoteBlockSymbolTrack] = sheet.noteblock_tracks
+		self.warnings: List[str] = sheet.warnings
+		self.red_tracks: List[RedPianoTrack] = sheet.red_tracks
+		self.storage_usage: StorageUsage = sheet.storage_usage
+		# storage usage if the red tracks were allocated in order, for comparison
+		self.naive_storage_usage: StorageUsage = sheet.naive_storage_usage
+		# (symbol storage, time mark storage) of each red track
+		self.storages: List[Tuple[ShulkerSheetStorage, ShulkerSheetStorage]] = sheet.storages
+		# (symbol storage commands, time mark storage commands) of each red track
+		self.commands: List[Tuple[StorageCommands, StorageCommands]] = sheet.commands
+
+	def render(self) -> str:
+		"""
+		:return: the text output of the compiling, as shown by the cli
+		"""
+		lines = [
+			'成功读取{}条简谱音轨，长度为{}'.format(self.track_amount, self.segment_amount),
+			'节奏模式: {}'.format(self.rhythm_mode.value),
+		]
+		lines.extend(self.warnings)
+		lines.append('翻译后音符序列:')
+		for i, track in enumerate(self.noteblock_tracks):
+			lines.append('简谱音轨#{}: '.format(i + 1) + ' '.join(map(lambda lst: '({})'.format(' '.join(map(str, lst))), track)))
+		if len(self.warnings) > 0:
+			lines.append('##################')
+			lines.append('>>> 警告: {}个 <<<'.format(len(self.warnings)))
+			lines.append('##################')
+
+		lines.append('')
+		lines.append('====== 音轨分析 ====== ')
+		lines.append('共需要{}条红乐音轨'.format(len(self.red_tracks)))
+		(stacks, shulkers), (naive_stacks, naive_shulkers) = self.storage_usage, self.naive_storage_usage
+		lines.append('共需要{}组物品，{}个潜影盒。按顺序分配音轨时需要{}组物品，{}个潜影盒，节省了{}组物品，{}个潜影盒'.format(stacks, shulkers, naive_stacks, naive_shulkers, naive_stacks - stacks, naive_shulkers - shulkers))
+		for i, track in enumerate(self.red_tracks):
+			lines.append('红乐音轨#{}'.format(i + 1))
+			lines.append('  ' + ' '.join(map(lambda track_item: str(track_item.symbol).rjust(2, ' ').ljust(4, ' '), track)))
+			lines.append('  ' + ' '.join(map(lambda track_item: str(track_item.time), track)))
+
+		lines.append('')
+		lines.append('====== 指令输出 ====== ')
+		for i, commands in enumerate(self.commands):
+			lines.append('> 红乐音轨#{}'.format(i + 1))
+			lines.extend(render_storage_commands(*commands))
+		return '\n'.join(lines) + '\n'
+
+	def to_dict(self) -> dict:
+		"""
+		:return: a json-serializable dict of the results
+		"""
+		return {
+			'rhythm_mode': self.rhythm_mode.name,
+			'track_amount': self.track_amount,
+			'segment_amount': self.segment_amount,
+			'noteblock_tracks': [[list(map(str, symbols)) for symbols in track] for track in self.noteblock_tracks],
+			'warnings': self.warnings,
+			'storage_usage': self.storage_usage._asdict(),
+			'red_tracks': [
+				{
+					'symbols': [str(track_item.symbol) for track_item in track],
+					'times': [track_item.time for track_item in track],
+					'symbol_shulker_amount': symbol_commands.shulker_amount,
+					'symbol_commands': symbol_commands.chest_commands,
+					'time_mark_shulker_amount': time_mark_commands.shulker_amount,
+					'time_mark_commands': time_mark_commands.chest_commands,
+				}
+				for track, (symbol_commands, time_mark_commands) in zip(self.red_tracks, self.commands)
+			],
+		}
+
+
+def compile_sheet(content: str, options: CompileOptions = CompileOptions()) -> CompileResult:
+	"""
+	Compile the sheet text. Nothing is printed, invalid sheets raise AssertionError or ValueError
+	Only the cache_dir, compact, mapping_file and parallel fields of the options are used here.
+	The mapping file only applies to this call, see mapping.use_mapping_file
+	"""
+	with mapping.use_mapping_file(options.mapping_file) if options.mapping_file is not None else contextlib.nullcontext():
+		sheet = Sheet.load(content)
+		if options.parallel is not None:
+			# imported here since multiprocessing is slow to import and only needed in parallel mode
+			import parallel
+			executor_context = parallel.create_executor(options.parallel or None)
+		else:
+			executor_context = contextlib.nullcontext()
+		cache = options.create_cache()
+		with executor_context as executor:
+			sheet.process_data(executor)
+			sheet.process_time_mark(cache)
+			sheet.generate_command(cache, options.compact, executor)
+	return CompileResult(sheet)
@@ -0,0 +1,162 @@
+import functools
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Callable, Optional, TypeVar, Any
+
+F = TypeVar('F', bound=Callable)
+# (stage name, wall time in seconds, traced memory delta in bytes or None)
+StageHook = Callable[[str, float, Optional[int]], None]
+
+
+class StageStat:
+	def __init__(self):
+		self.calls = 0
+		self.seconds = 0.0
+		self.memory_delta: Optional[int] = None
+
+	def to_dict(self) -> dict:
+		return {
+			'calls': self.calls,
+			'seconds': self.seconds,
+			'memory_delta_bytes': self.memory_delta,
+		}
+
+
+class Instrumentation:
+	"""
+	Collects the wall time, call count and traced memory delta of each instrumented stage,
+	and the sizes of the generated give commands
+	"""
+	def __init__(self, trace_memory: bool = True):
+		self.trace_memory = trace_memory
+		self.stages: Dict[str, StageStat] = {}
+		# command kind -> utf8 byte size of each command
+		self.commands: Dict[str, List[int]] = {}
+		self.__hooks: List[StageHook] = []
+
+	def add_hook(self, hook: StageHook):
+		"""
+		Register a callback that will be invoked every time an instrumented stage finishes
+		"""
+		self.__hooks.append(hook)
+
+	def run_stage(self, name: str, func: Callable, args: tuple, kwargs: dict) -> Any:
+		trace_memory = self.trace_memory and tracemalloc.is_tracing()
+		memory = tracemalloc.get_traced_memory()[0] if trace_memory else 0
+		start = time.perf_counter()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			cost = time.perf_counter() - start
+			memory_delta = tracemalloc.get_traced_memory()[0] - memory if trace_memory else None
+			self.record_stage(name, cost, memory_delta)
+
+	def record_stage(self, name: str, seconds: float, memory_delta: Optional[int]):
+		stat = self.stages.get(name)
+		if stat is None:
+			stat = self.stages[name] = StageStat()
+		stat.calls += 1
+		stat.seconds += seconds
+		if memory_delta is not None:
+			stat.memory_delta = (stat.memory_delta or 0) + memory_delta
+		for hook in self.__hooks:
+			hook(name, seconds, memory_delta)
+
+	def merge_stages(self, stages: Dict[str, StageStat]):
+		"""
+		Add the stage stats collected by another instrumentation, e.g. in a worker process. The hooks are not invoked
+		"""
+		for name, other in stages.items():
+			stat = self.stages.get(name)
+			if stat is None:
+				stat = self.stages[name] = StageStat()
+			stat.calls += other.calls
+			stat.seconds += other.seconds
+			if other.memory_delta is not None:
+				stat.memory_delta = (stat.memory_delta or 0) + other.memory_delta
+
+	def record_commands(self, kind: str, commands: List[str]):
+		self.record_command_sizes(kind, [len(command.encode('utf8')) for command in commands])
+
+	def record_command_sizes(self, kind: str, sizes: List[int]):
+		"""
+		:param sizes: the byte size of each command
+		"""
+		self.commands.setdefault(kind, []).extend(sizes)
+
+	def to_dict(self) -> dict:
+		commands = {}
+		for kind, sizes in self.commands.items():
+			commands[kind] = {
+				'count': len(sizes),
+				'total_bytes': sum(sizes),
+				'max_bytes': max(sizes, default=0),
+				'mean_bytes': sum(sizes) / len(sizes) if len(sizes) > 0 else 0,
+			}
+		return {
+			'stages': {name: stat.to_dict() for name, stat in self.stages.items()},
+			'commands': commands,
+		}
+
+	def save(self, file_path: str):
+		with open(file_path, 'w', encoding='utf8') as f:
+			json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+
+
+_current: Optional[Instrumentation] = None
+
+
+def get_current() -> Optional[Instrumentation]:
+	return _current
+
+
+@contextmanager
+def enable(instrumentation: Instrumentation):
+	"""
+	Activate the given instrumentation within the context. tracemalloc is started if memory tracing is required
+	"""
+	global _current
+	prev = _current
+	started_tracing = instrumentation.trace_memory and not tracemalloc.is_tracing()
+	if started_tracing:
+		tracemalloc.start()
+	_current = instrumentation
+	try:
+		yield instrumentation
+	finally:
+		_current = prev
+		if started_tracing:
+			tracemalloc.stop()
+
+
+def stage(name: str) -> Callable[[F], F]:
+	"""
+	Decorator to record the decorated function as a stage of the current instrumentation.
+	Costs nothing but a global lookup when instrumentation is disabled
+	"""
+	def decorator(func: F) -> F:
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			instrumentation = _current
+			if instrumentation is None:
+				return func(*args, **kwargs)
+			return instrumentation.run_stage(name, func, args, kwargs)
+		return wrapper
+	return decorator
+
+
+def merge_stages(stages: Dict[str, StageStat]):
+	if _current is not None:
+		_current.merge_stages(stages)
+
+
+def record_commands(kind: str, commands: List[str]):
+	if _current is not None:
+		_current.record_commands(kind, commands)
+
+
+def record_command_sizes(kind: str, sizes: List[int]):
+	if _current is not None:
+		_current.record_command_sizes(kind, sizes)
@@ -0,0 +1,208 @@
+"""
+A compact binary intermediate format of a compiled sheet, so downstream tools can load the translated 简谱 tracks
+and the red tracks without running the pipeline again
+
+All fields are little-endian and every section is aligned to 4 bytes:
+
+	header                  see _HEADER
+	red track run offsets   uint32[red track amount + 1], the runs of red track i are [offsets[i], offsets[i + 1])
+	symbol amounts          uint8[简谱 track amount * segment amount], the amount of symbols in each segment (1, 2 or 4)
+	symbol notes            int8[简谱 track amount * segment amount * 4], the notes of each segment, padded to 4
+	run lengths             uint32[run amount]
+	run notes               int8[run amount]
+	run time marks          uint8[run amount]
+
+The reader maps the file into memory and exposes the sections as memoryviews, so opening a file costs the same
+regardless of its size, and only the accessed parts are read from the disk
+"""
+import mmap
+import struct
+import sys
+from array import array
+from typing import List, Tuple
+
+from sheet import RhythmMode, NoteBlockSymbolTrack
+from symbol import NoteBlockSymbol
+from track import RedPianoTrack
+
+MAGIC = b'RPIR'
+VERSION = 1
+SEGMENT_WIDTH = 4  # max amount of symbols in a segment
+
+# magic, version, rhythm mode, reserved, segment amount, 简谱 track amount, red track amount, run amount
+_HEADER = struct.Struct('<4sHBxIIII')
+# rhythm mode code in the file -> rhythm mode
+_RHYTHM_MODES = (RhythmMode.short_tone, RhythmMode.long_tone)
+
+
+def _align(size: int) -> int:
+	return (size + 3) // 4 * 4
+
+
+def _to_little_endian(data: array) -> bytes:
+	if sys.byteorder != 'little':
+		data = array(data.typecode, data)
+		data.byteswap()
+	return data.tobytes()
+
+
+def write_intermediate(file_path: str, rhythm_mode: RhythmMode, noteblock_tracks: List[NoteBlockSymbolTrack], red_tracks: List[RedPianoTrack]):
+	"""
+	Save the results of Sheet.process_data and Sheet.process_time_mark into the file
+	"""
+	segment_amount = len(noteblock_tracks[0]) if len(noteblock_tracks) > 0 else 0
+	symbol_amounts = array('B')
+	symbol_notes = array('b')
+	for track in noteblock_tracks:
+		if len(track) != segment_amount:
+			raise ValueError('The 简谱 tracks should have the same length')
+		for symbols in track:
+			symbol_amounts.append(len(symbols))
+			symbol_notes.extend([symbol.note for symbol in symbols])
+			symbol_notes.extend([0] * (SEGMENT_WIDTH - len(symbols)))
+
+	run_offsets = array('I', [0])
+	run_lengths = array('I')
+	run_notes = array('b')
+	run_time_marks = array('B')
+	for track in red_tracks:
+		run_lengths.fromlist(track.lengths.tolist())
+		run_notes.extend(track.notes)
+		run_time_marks.extend(track.time_marks)
+		run_offsets.append(len(run_lengths))
+
+	sections = [
+		_HEADER.pack(MAGIC, VERSION, _RHYTHM_MODES.index(rhythm_mode), segment_amount, len(noteblock_tracks), len(red_tracks), len(run_lengths)),
+		_to_little_endian(run_offsets),
+		symbol_amounts.tobytes(),
+		symbol_notes.tobytes(),
+		_to_little_endian(run_lengths),
+		run_notes.tobytes(),
+		run_time_marks.tobytes(),
+	]
+	with open(file_path, 'wb') as file:
+		for section in sections:
+			file.write(section)
+			file.write(bytes(_align(len(section)) - len(section)))
+
+
+class IntermediateReader:
+	"""
+	Reads an intermediate file with mmap. The memoryviews returned are only valid until the reader is closed,
+	and should be released before that
+
+		with IntermediateReader('output.rpi') as reader:
+			red_tracks = reader.get_red_tracks()
+	"""
+	run_offsets: memoryview
+	symbol_amounts: memoryview
+	symbol_notes: memoryview
+	run_lengths: memoryview
+	run_notes: memoryview
+	run_time_marks: memoryview
+
+	def __init__(self, file_path: str):
+		self.file_path = file_path
+		self.__views: List[memoryview] = []
+		with open(file_path, 'rb') as file:
+			try:
+				self.__mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# mapping an empty file is not allowed
+				raise ValueError('{} is not a RedPiano intermediate file'.format(file_path)) from None
+		try:
+			self.__load()
+		except:
+			self.close()
+			raise
+
+	def __load(self):
+		buffer = memoryview(self.__mmap)
+		self.__views.append(buffer)
+		if len(buffer) < _HEADER.size or bytes(buffer[:len(MAGIC)]) != MAGIC:
+			raise ValueError('{} is not a RedPiano intermediate file'.format(self.file_path))
+		_, version, rhythm_mode, self.segment_amount, self.noteblock_track_amount, self.red_track_amount, self.run_amount = _HEADER.unpack_from(buffer)
+		if version != VERSION:
+			raise ValueError('Unsupported intermediate format version {} of {}, expected {}'.format(version, self.file_path, VERSION))
+		if rhythm_mode >= len(_RHYTHM_MODES):
+			raise ValueError('Unknown rhythm mode {} in {}'.format(rhythm_mode, self.file_path))
+		self.rhythm_mode: RhythmMode = _RHYTHM_MODES[rhythm_mode]
+
+		symbol_amount = self.noteblock_track_amount * self.segment_amount
+		# (field name, size, typecode) of the sections
+		sections = [
+			('run_offsets', 4 * (self.red_track_amount + 1), 'I'),
+			('symbol_amounts', symbol_amount, 'B'),
+			('symbol_notes', symbol_amount * SEGMENT_WIDTH, 'b'),
+			('run_lengths', 4 * self.run_amount, 'I'),
+			('run_notes', self.run_amount, 'b'),
+			('run_time_marks', self.run_amount, 'B'),
+		]
+		if len(buffer) < _HEADER.size + sum(_align(size) for _, size, _ in sections):
+			raise ValueError('{} is truncated'.format(self.file_path))
+		offset = _HEADER.size
+		for name, size, typecode in sections:
+			view = buffer[offset:offset + size].cast(typecode)
+			if typecode == 'I' and sys.byteorder != 'little':
+				# not zero-copy on big-endian machines
+				data = array('I', view.tobytes())
+				data.byteswap()
+				view.release()
+				view = memoryview(data)
+			self.__views.append(view)
+			setattr(self, name, view)
+			offset += _align(size)
+		# the runs of the red tracks are sliced with the offsets, which must cover all runs in order
+		offsets = self.run_offsets
+		if offsets[0] != 0 or offsets[-1] != self.run_amount or any(offsets[i] > offsets[i + 1] for i in range(self.red_track_amount)):
+			raise ValueError('{} is corrupt, invalid run offsets'.format(self.file_path))
+
+	def get_segment(self, track_index: int, segment_index: int) -> List[NoteBlockSymbol]:
+		"""
+		:return: the note block symbols of a segment of a 简谱 track
+		"""
+		if not (0 <= track_index < self.noteblock_track_amount and 0 <= segment_index < self.segment_amount):
+			raise IndexError('Segment {} of track {} out of range'.format(segment_index, track_index))
+		index = track_index * self.segment_amount + segment_index
+		start = index * SEGMENT_WIDTH
+		return [NoteBlockSymbol(note) for note in self.symbol_notes[start:start + self.symbol_amounts[index]]]
+
+	def get_noteblock_track(self, track_index: int) -> NoteBlockSymbolTrack:
+		if not 0 <= track_index < self.noteblock_track_amount:
+			raise IndexError('Track {} out of range'.format(track_index))
+		start = track_index * self.segment_amount
+		amounts = self.symbol_amounts[start:start + self.segment_amount].tolist()
+		notes = self.symbol_notes[start * SEGMENT_WIDTH:(start + self.segment_amount) * SEGMENT_WIDTH].tolist()
+		return [[NoteBlockSymbol(note) for note in notes[i * SEGMENT_WIDTH:i * SEGMENT_WIDTH + amount]] for i, amount in enumerate(amounts)]
+
+	def get_noteblock_tracks(self) -> List[NoteBlockSymbolTrack]:
+		return [self.get_noteblock_track(i) for i in range(self.noteblock_track_amount)]
+
+	def get_red_track_runs(self, track_index: int) -> Tuple[memoryview, memoryview, memoryview]:
+		"""
+		:return: views of the (notes, time marks, lengths) of the runs of a red track, see RedPianoTrack
+		"""
+		if not 0 <= track_index < self.red_track_amount:
+			raise IndexError('Red track {} out of range'.format(track_index))
+		start, end = self.run_offsets[track_index], self.run_offsets[track_index + 1]
+		return self.run_notes[start:end], self.run_time_marks[start:end], self.run_lengths[start:end]
+
+	def get_red_track(self, track_index: int) -> RedPianoTrack:
+		notes, time_marks, lengths = self.get_red_track_runs(track_index)
+		with notes, time_marks, lengths:
+			return RedPianoTrack.from_runs(notes, time_marks, lengths)
+
+	def get_red_tracks(self) -> List[RedPianoTrack]:
+		return [self.get_red_track(i) for i in range(self.red_track_amount)]
+
+	def close(self):
+		for view in reversed(self.__views):
+			view.release()
+		self.__views.clear()
+		self.__mmap.close()
+
+	def __enter__(self) -> 'IntermediateReader':
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
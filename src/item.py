@@ -1,17 +1,93 @@
+import functools
+import hashlib
 import json
+import re
 from abc import ABC
-from typing import List, Optional
+from typing import List, Optional, Tuple, Dict
 
+import instrument
+from mapping import get_mapping
 from serializer import Serializable
 
-with open('mapping.json') as file:
-	MAPPING_DATA = json.load(file)
-
 
 def to_json_str(data, compact: bool = True) -> str:
 	return json.dumps(data, ensure_ascii=False, separators=(',', ':') if compact else None)
 
 
+@functools.lru_cache(maxsize=1024)
+def _encode_name_tag(name: str) -> str:
+	"""
+	The "display" entry of the item tag, without the surrounding braces
+	"""
+	return to_json_str({'display': {'Name': to_json_str({'text': name}, compact=False)}})[1:-1]
+
+
+def _assemble_item_json(id_: str, tag_json: str, slot, count) -> str:
+	"""
+	Same as to_json_str(item.to_dict()), with the tag already encoded
+	"""
+	text = '{"id":' + to_json_str(id_) + ',"tag":' + tag_json
+	if slot is not None:
+		text += ',"Slot":' + to_json_str(slot)
+	if count is not None:
+		text += ',"Count":' + to_json_str(count)
+	return text + '}'
+
+
+@functools.lru_cache(maxsize=65536)
+def _encode_item(id_: str, name: Optional[str], count, slot) -> str:
+	return _assemble_item_json(id_, '{' + _encode_name_tag(name) + '}' if name is not None else '{}', slot, count)
+
+
+# ====== compact SNBT encoding ======
+# Optional names are dropped, keys and ids are unquoted, and the minecraft namespace is omitted
+
+_SNBT_UNQUOTED_PATTERN = re.compile(r'[0-9A-Za-z_\-.+]+')
+
+
+def to_snbt_str(text: str) -> str:
+	if _SNBT_UNQUOTED_PATTERN.fullmatch(text) and text[0] not in '0123456789-+.' and text not in ('true', 'false'):
+		return text
+	# prefer single quotes, since the quoted text is usually a json text component full of double quotes
+	if "'" in text and '"' not in text:
+		return '"' + text.replace('\\', '\\\\') + '"'
+	return "'" + text.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def _compact_id(id_: str) -> str:
+	return to_snbt_str(id_[len('minecraft:'):] if id_.startswith('minecraft:') else id_)
+
+
+def _assemble_item_snbt(id_: str, tag_snbt: Optional[str], slot, count) -> str:
+	text = '{id:' + _compact_id(id_)
+	if count is not None:
+		text += ',Count:{}b'.format(count)
+	if slot is not None:
+		text += ',Slot:{}b'.format(slot)
+	if tag_snbt is not None:
+		text += ',tag:' + tag_snbt
+	return text + '}'
+
+
+@functools.lru_cache(maxsize=65536)
+def _encode_item_compact(id_: str, count, slot) -> str:
+	return _assemble_item_snbt(id_, None, slot, count)
+
+
+ItemStack = Tuple[str, Optional[str], int]  # (id, name, count) of an item stack in a shulker
+
+
+@functools.lru_cache(maxsize=16384)
+def _encode_shulker_tag(stacks: Tuple[ItemStack, ...], compact: bool) -> str:
+	"""
+	The tag of an unnamed shulker holding the item stacks, the same as Shulker.encode_tag(compact).
+	The result is cached by the stacks, so the unchanged shulkers of a recompiled sheet are not encoded again
+	"""
+	if compact:
+		return '{BlockEntityTag:{Items:[' + ','.join([_encode_item_compact(id_, count, slot) for slot, (id_, _, count) in enumerate(stacks)]) + ']}}'
+	return '{"BlockEntityTag":{"Items":[' + ','.join([_encode_item(id_, name, count, slot) for slot, (id_, name, count) in enumerate(stacks)]) + ']}}'
+
+
 class Item(Serializable):
 	id: str
 	name: Optional[str] = None
@@ -41,16 +117,49 @@ class Item(Serializable):
 	def append_block_entity_tag(self, tags: dict):
 		pass
 
+	def to_json(self) -> str:
+		"""
+		The compact json of to_dict(). The result is cached by (id, name, count, slot)
+		"""
+		return _encode_item(self.id, self.name, self.count, self.slot)
+
+	def to_snbt(self) -> str:
+		"""
+		The compact SNBT of the item, without the name. The result is cached by (id, count, slot)
+		"""
+		return _encode_item_compact(self.id, self.count, self.slot)
+
 
 class Container(Item, ABC):
 	items: List[Item] = []
 	name: Optional[str] = None
 
-	def to_give_command(self) -> str:
-		nbt = {}
-		self.append_name_tag(nbt)
-		self.append_block_entity_tag(nbt)
-		return '/give @p {}{}'.format(self.id, to_json_str(nbt))
+	def to_give_command(self, compact: bool = False) -> str:
+		return '/give @p {}{}'.format(_compact_id(self.id) if compact else self.id, self.encode_tag(compact))
+
+	def encode_tag(self, compact: bool = False, keep_name: bool = True) -> str:
+		"""
+		The tag of the container, including the items inside
+		:param keep_name: only for the compact encoding, whether to keep the name of the container
+		"""
+		if compact:
+			text = '{'
+			if keep_name and self.name is not None:
+				# a plain json string is a valid text component too
+				text += 'display:{Name:' + to_snbt_str(to_json_str(self.name)) + '},'
+			return text + 'BlockEntityTag:{Items:[' + ','.join([item.to_snbt() for item in self.items]) + ']}}'
+		# concatenate the cached item fragments instead of dumping the whole nested dict
+		text = '{'
+		if self.name is not None:
+			text += _encode_name_tag(self.name) + ','
+		return text + '"BlockEntityTag":{"Items":[' + ','.join([item.to_json() for item in self.items]) + ']}}'
+
+	def to_json(self) -> str:
+		return _assemble_item_json(self.id, self.encode_tag(), self.slot, self.count)
+
+	def to_snbt(self) -> str:
+		# names of the nested containers are dropped too
+		return _assemble_item_snbt(self.id, self.encode_tag(compact=True, keep_name=False), self.slot, self.count)
 
 	def add_item(self, item: Item):
 		item.slot = len(self.items)
@@ -71,76 +180,228 @@ class Chest(Container):
 
 
 CMD_BLOCK_LIMIT = 32000  # real value: 32500
+ITEM_STACK_LIMIT = 64
+
+
+class StorageBuild:
+	"""
+	The frozen shulkers of a ShulkerSheetStorage. Every shulker is serialized only once,
+	and the exported commands are cached, so all exports share the same serialization work
+	"""
+	def __init__(self, name: Optional[str], compact: bool, shulker_stacks: Tuple[Tuple[ItemStack, ...], ...]):
+		self.name = name
+		self.compact = compact
+		# the item stacks of each shulker
+		self.shulker_stacks = shulker_stacks
+		self.__shulkers: Optional[Tuple[Shulker, ...]] = None
+		self.__give_commands: Dict[bool, List[str]] = {}
+		self.__chest_commands: Optional[List[str]] = None
+
+	def __getstate__(self):
+		# the cached commands are not worth transferring to other processes
+		return self.name, self.compact, self.shulker_stacks
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+	@property
+	def shulker_amount(self) -> int:
+		return len(self.shulker_stacks)
+
+	@property
+	def shulkers(self) -> Tuple[Shulker, ...]:
+		"""
+		The shulkers as items, only created when needed since the commands are encoded from the stacks directly
+		"""
+		if self.__shulkers is None:
+			shulkers = []
+			for stacks in self.shulker_stacks:
+				shulker = Shulker.get_default()
+				for id_, name, count in stacks:
+					shulker.add_item(Item(id=id_, count=count, name=name))
+				shulkers.append(shulker)
+			self.__shulkers = tuple(shulkers)
+		return self.__shulkers
+
+	def __get_tags(self, compact: bool) -> List[str]:
+		"""
+		The tags of the shulkers in the chests. Shulkers in a storage have no name,
+		so they are also the tags of the give commands
+		"""
+		return [_encode_shulker_tag(stacks, compact) for stacks in self.shulker_stacks]
+
+	def get_give_commands(self, compact: Optional[bool] = None) -> List[str]:
+		"""
+		The give command of each shulker
+		:param compact: the encoding to use. Default: the encoding of the storage
+		"""
+		if compact is None:
+			compact = self.compact
+		commands = self.__give_commands.get(compact)
+		if commands is None:
+			id_ = _compact_id(Shulker.id) if compact else Shulker.id
+			commands = ['/give @p ' + id_ + tag for tag in self.__get_tags(compact)]
+			self.__give_commands[compact] = commands
+		return commands
+
+	def get_give_command_sizes(self) -> List[int]:
+		"""
+		The byte size of the give command of each shulker, in the encoding of the storage.
+		The commands are not assembled if they are not exported yet
+		"""
+		commands = self.__give_commands.get(self.compact)
+		if commands is None:
+			prefix_size = len(('/give @p ' + (_compact_id(Shulker.id) if self.compact else Shulker.id)).encode('utf8'))
+			return [prefix_size + len(tag.encode('utf8')) for tag in self.__get_tags(self.compact)]
+		return [len(command.encode('utf8')) for command in commands]
+
+	@instrument.stage('StorageBuild.get_chest_commands')
+	def get_chest_commands(self) -> List[str]:
+		"""
+		Pack the shulkers into chests, as many as the command length limit allows, and return the give commands of the chests
+		"""
+		if self.__chest_commands is None:
+			self.__chest_commands = self.__pack_chests()
+		return self.__chest_commands
+
+	def __get_empty_chest_command(self, name: Optional[str]) -> str:
+		chest = Chest.get_default()
+		chest.name = name
+		return chest.to_give_command(self.compact)
+
+	def __pack_chests(self) -> List[str]:
+		assemble = _assemble_item_snbt if self.compact else _assemble_item_json
+		# [name, item fragments] of each chest
+		chests: List[list] = []
+		chest: Optional[list] = None
+		chest_len = 0
+		for tag in self.__get_tags(self.compact):
+			if chest is None or len(chest[1]) == 27:
+				chest = self.__new_chest(chests, split=False)
+				chest_len = len(self.__get_empty_chest_command(chest[0]))
+			fragment = assemble(Shulker.id, tag, len(chest[1]), 1)
+			# the new item fragment, with a leading comma if it's not the first one
+			new_len = chest_len + len(fragment) + (1 if len(chest[1]) > 0 else 0)
+			if new_len > CMD_BLOCK_LIMIT:
+				chest = self.__new_chest(chests, split=True)
+				chest_len = len(self.__get_empty_chest_command(chest[0]))
+				fragment = assemble(Shulker.id, tag, 0, 1)
+				new_len = chest_len + len(fragment)
+			chest[1].append(fragment)
+			chest_len = new_len
+		commands = []
+		for name, fragments in chests:
+			empty_command = self.__get_empty_chest_command(name)
+			# insert the fragments into the empty item list at the end, i.e. ...Items:[]}}
+			commands.append(empty_command[:-3] + ','.join(fragments) + empty_command[-3:])
+		return commands
+
+	def __new_chest(self, chests: List[list], split: bool) -> list:
+		"""
+		:param split: if the previous chest is split due to the command length limit, it's numbered too
+		"""
+		if split:
+			chests[-1][0] += str(len(chests))
+		name = self.name
+		if len(chests) > 0:
+			name += str(len(chests) + 1)
+		chest = [name, []]
+		chests.append(chest)
+		return chest
 
 
 class ShulkerSheetStorage:
-	def __init__(self, name: Optional[str] = None):
+	def __init__(self, name: Optional[str] = None, compact: bool = False):
+		"""
+		:param compact: use the compact SNBT encoding in the exported commands, see Item.to_snbt
+		"""
 		self.name = name
-		self.__shulkers: List[Shulker] = []
-		self.__pending_items: List[Item] = []
-
-	def __add_shulker(self, items: List[Item]):
-		assert len(items) <= 27
-		if len(items) == 0:
-			return
-		shulker = Shulker.get_default()
-		for item in items:
-			shulker.add_item(Item(
-				id=item.id,
-				count=item.count,
-				name=item.name
-			))
-		self.__shulkers.append(shulker)
+		self.compact = compact
+		# [id, name, count] of each item stack, 27 stacks per shulker
+		self.__stacks: List[list] = []
+		# (id, name, count, amount) of the item runs added but not stacked yet, see add_item_run
+		self.__runs: List[Tuple[str, Optional[str], int, int]] = []
+		self.__build: Optional[StorageBuild] = None
 
+	@instrument.stage('ShulkerSheetStorage.add_item')
 	def add_item(self, item: Item):
-		if len(self.__pending_items) > 0:
-			last_one = self.__pending_items[-1]
-			if last_one.id == item.id:
-				if last_one.count + item.count <= 64:
-					last_one.count += item.count
-				else:
-					print('WARN: {} has >64 count'.format(last_one.id))
+		assert self.__build is None, 'Cannot add items to a built storage'
+		self.__stack_runs()
+		if len(self.__stacks) > 0:
+			last_one = self.__stacks[-1]
+			# a full stack is continued in the next slot
+			if last_one[0] == item.id and last_one[2] + item.count <= ITEM_STACK_LIMIT:
+				last_one[2] += item.count
 				return
-		self.__pending_items.append(item)
-		if len(self.__pending_items) > 27:
-			self.__add_shulker(self.__pending_items[:27])
-			self.__pending_items = self.__pending_items[27:]
+		self.__stacks.append([item.id, item.name, item.count])
+
+	@instrument.stage('ShulkerSheetStorage.add_item_run')
+	def add_item_run(self, item: Item, amount: int):
+		"""
+		Add amount copies of the item in bulk. The same as calling add_item amount times, but the stacks are only
+		merged when they are needed, so a storage whose commands are cached never stacks its items
+		"""
+		assert self.__build is None, 'Cannot add items to a built storage'
+		if amount > 0:
+			self.__runs.append((item.id, item.name, item.count, amount))
+
+	def __stack_runs(self):
+		stacks = self.__stacks
+		for id_, name, count, amount in self.__runs:
+			if len(stacks) > 0:
+				last_one = stacks[-1]
+				if last_one[0] == id_:
+					merged = min(amount, (ITEM_STACK_LIMIT - last_one[2]) // count)
+					if merged > 0:
+						last_one[2] += merged * count
+						amount -= merged
+			stack_size = max(1, ITEM_STACK_LIMIT // count)
+			full_stacks, rest = divmod(amount, stack_size)
+			stacks.extend([id_, name, stack_size * count] for _ in range(full_stacks))
+			if rest > 0:
+				stacks.append([id_, name, rest * count])
+		self.__runs.clear()
+
+	def fingerprint(self) -> str:
+		"""
+		A hash of the name and all items added so far, which decides the exported commands.
+		Should be called before build()
+		"""
+		sha = hashlib.sha256('{}\0{}'.format(self.name, self.compact).encode('utf8'))
+		sha.update('\0'.join(['{}\0{}\0{}'.format(*stack) for stack in self.__stacks]).encode('utf8'))
+		# the runs are hashed as they are instead of being stacked first
+		sha.update(b'\1')
+		sha.update('\0'.join(['{}\0{}\0{}\0{}'.format(*run) for run in self.__runs]).encode('utf8'))
+		return sha.hexdigest()
+
+	@instrument.stage('ShulkerSheetStorage.build')
+	def build(self) -> StorageBuild:
+		"""
+		Pad the last shulker with dummy items, and freeze the storage.
+		No more items can be added afterwards. The build is created only once
+		"""
+		if self.__build is None:
+			self.__stack_runs()
+			pending_amount = len(self.__stacks) % 27
+			if pending_amount > 0:
+				dummy = get_mapping().dummy
+				for i in range(27 - pending_amount):
+					self.add_item(Item(id=dummy[i % len(dummy)], count=1, name='dummy'))
+			stacks = [tuple(stack) for stack in self.__stacks]
+			self.__build = StorageBuild(self.name, self.compact, tuple(tuple(stacks[i:i + 27]) for i in range(0, len(stacks), 27)))
+		return self.__build
+
+	def get_shulkers(self) -> Tuple[Shulker, ...]:
+		return self.build().shulkers
 
 	def done(self) -> List[str]:
-		if len(self.__pending_items) > 0:
-			for i in range(27 - len(self.__pending_items)):
-				self.add_item(Item(id=MAPPING_DATA['dummy'][i % 2], count=1, name='dummy'))
-		self.__add_shulker(self.__pending_items)
-		self.__pending_items.clear()
-		return [shulker.to_give_command() for shulker in self.__shulkers]
+		"""
+		Build the storage and return the give commands of the shulkers, in the default encoding
+		"""
+		return self.build().get_give_commands(compact=False)
 
 	def export_give_command(self) -> List[str]:
-		return [shulker.to_give_command() for shulker in self.__shulkers]
+		return self.build().get_give_commands()
 
 	def export_give_chest_command(self) -> List[str]:
-		def get_chest():
-			nonlocal chest, chest_cnt
-			if chest is not None:
-				chest.name += str(chest_cnt)
-			chest = Chest.get_default()
-			chests.append(chest)
-			chest_cnt += 1
-			chest.name = self.name
-			if chest_cnt > 1:
-				chest.name += str(chest_cnt)
-
-		chests: List[Chest] = []
-		chest: Optional[Chest] = None
-		chest_cnt = 0
-		for i, shulker in enumerate(self.__shulkers):
-			if chest is None:
-				get_chest()
-			shulker.count = 1
-			chest.add_item(shulker)
-			if len(chest.to_give_command()) > CMD_BLOCK_LIMIT:
-				chest.items.pop(len(chest.items) - 1)
-				get_chest()
-				chest.add_item(shulker)
-			if len(chest.items) == 27:
-				chest = None
-		return [chest.to_give_command() for chest in chests]
+		return self.build().get_chest_commands()
@@ -1,10 +1,16 @@
+import argparse
+import contextlib
 import os
 import sys
 import traceback
 from contextlib import contextmanager
+from typing import Optional, TextIO
 
+import batch
+import compiler
+import instrument
+import mapping
 from item import ShulkerSheetStorage
-from sheet import Sheet
 from symbol import NoteBlockSymbol
 from track import RedPianoTrackItem
 
@@ -29,46 +35,127 @@ def dump_items():
 	print()
 
 
-def process_sheet():
+def process_sheet(options: compiler.CompileOptions):
 	if not os.path.isfile('input.txt'):
 		print('输入文件"input.txt"未找到')
 		return
-	with open('input.txt', encoding='utf8') as f:
-		sheet = Sheet.load(f.read())
-	sheet.process_data()
-	sheet.process_time_mark()
-	sheet.generate_command()
+	instrumentation = instrument.Instrumentation()
+	with open('input.txt', encoding='utf8') as f, instrument.enable(instrumentation) if options.report else contextlib.nullcontext():
+		if options.stream:
+			batch.compile_sheet_stream(f, options)
+		else:
+			batch.compile_sheet(f.read(), options)
+	if options.report:
+		report_path = batch.get_report_path('output.txt')
+		instrumentation.save(report_path)
+		print('性能报告已保存至{}'.format(report_path))
 
 
-class FakeStdOut(object):
-	def __init__(self):
+class OutputSink(object):
+	"""
+	A stdout replacement that writes everything into the output file with a single buffered file handle,
+	and optionally echos the content to another stream
+	"""
+	def __init__(self, file_path: str, echo: Optional[TextIO], line_buffered: bool = False):
 		self.terminal = sys.stdout
-		open('output.txt', 'w').close()
+		self.echo = echo
+		self.file = open(file_path, 'w', encoding='utf8', buffering=1 if line_buffered else -1)
 
-	def write(self, message):
-		self.terminal.write(message)
-		with open('output.txt', 'a', encoding='utf8') as f:
-			f.write(message)
+	def write(self, message: str):
+		if self.echo is not None:
+			self.echo.write(message)
+		self.file.write(message)
+
+	def flush(self):
+		if self.echo is not None:
+			self.echo.flush()
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
 
 	@classmethod
 	@contextmanager
-	def wrap(cls):
-		wrapper = FakeStdOut()
+	def wrap(cls, file_path: str = 'output.txt', echo: Optional[TextIO] = None, line_buffered: bool = False):
+		wrapper = OutputSink(file_path, echo, line_buffered)
 		sys.stdout = wrapper
 		try:
 			yield
 		finally:
 			sys.stdout = wrapper.terminal
+			wrapper.close()
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(prog='RedPiano')
+	parser.add_argument('-b', '--batch', nargs='+', metavar='PATH', help='Non-interactively compile all sheets matched by the given directories / glob patterns')
+	parser.add_argument('-o', '--output-dir', default='output', help='The directory to store the output of each sheet in batch mode. Default: output')
+	parser.add_argument('-j', '--jobs', type=int, default=None, help='The amount of worker processes in batch mode and server mode. Default: cpu count')
+	parser.add_argument('-w', '--watch', nargs='*', metavar='PATH', default=None, help='Keep running and recompile the sheets whenever they are modified. Without paths, input.txt is compiled into output.txt, otherwise like --batch')
+	parser.add_argument('--verify', nargs='+', metavar='PATH', default=None, help='Compile the sheets matched by the given directories / glob patterns, and replay the red tracks and the shulker items with a decoder simulator to check that they play the same notes as the 简谱 tracks')
+	parser.add_argument('--serve', nargs='?', type=int, const=8765, default=None, metavar='PORT', help='Run a resident compile server on localhost, see server.py for the http api. Uses -j worker processes. Default port: 8765')
+	parser.add_argument('--host', default='127.0.0.1', help='The address the compile server listens on. Default: 127.0.0.1')
+	parser.add_argument('--stream', action='store_true', help='Read the sheet line by line and skip the per-track analysis output, to reduce the memory usage on very large sheets')
+	parser.add_argument('--report', action='store_true', help='Record the time cost, call count and memory delta of each stage, and the sizes of the commands, into a json report next to the output file')
+	parser.add_argument('--cache', nargs='?', const='.redpiano_cache', default=None, metavar='DIR', help='Cache the compile results in the given directory, so unchanged sheets and red tracks are not compiled again. Default directory: .redpiano_cache')
+	parser.add_argument('--export', nargs='+', choices=list(batch.EXPORT_FORMATS.keys()), default=[], metavar='FORMAT', help='Also export the chests of the whole song into files next to the output file, so it can be imported in one step. Formats: structure (gzip NBT structure file, .nbt), mcfunction (datapack function, .mcfunction), intermediate (binary red tracks for other tools, .rpi, not available in stream mode)')
+	parser.add_argument('--parallel', nargs='?', type=int, const=0, default=None, metavar='N', help='Translate the 简谱 tracks and generate the commands of the red tracks on N worker processes (threads on free-threaded builds). Default N: cpu count. Not used in stream mode')
+	parser.add_argument('--compact', action='store_true', help='Use a compact SNBT encoding without item names in the give commands, so more shulkers fit in a chest command')
+	parser.add_argument('--mapping', default=None, metavar='FILE', help='The item mapping file to use. Default: mapping.json in the working directory, or next to the program')
+	parser.add_argument('--echo', choices=['stdout', 'stderr', 'none'], default='stdout', help='Where to echo the content written to output.txt. Default: stdout')
+	parser.add_argument('--line-buffered', action='store_true', help='Flush output.txt on every line instead of on exit')
+	return parser.parse_args()
 
 
 def main():
+	args = parse_args()
+	options = compiler.CompileOptions(
+		stream=args.stream,
+		report=args.report,
+		cache_dir=args.cache,
+		export_formats=tuple(args.export),
+		compact=args.compact,
+		mapping_file=args.mapping,
+		parallel=args.parallel,
+	)
+	if args.mapping is not None:
+		mapping.set_mapping_file(args.mapping)
+	if args.serve is not None:
+		import server
+		server.serve(args.host, args.serve, args.jobs, options)
+		return
+	if args.watch is not None:
+		import watch
+		if len(args.watch) == 0:
+			files = [('input.txt', 'output.txt')]
+		else:
+			paths = batch.collect_sheet_files(args.watch)
+			try:
+				output_paths = batch.get_output_paths(paths, args.output_dir)
+			except ValueError as e:
+				print(e)
+				sys.exit(1)
+			for output_path in output_paths:
+				os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+			files = list(zip(paths, output_paths))
+		watch.run_watch(files, options)
+		return
+	if args.verify is not None:
+		import simulator
+		results = simulator.run_verify(batch.collect_sheet_files(args.verify), options)
+		sys.exit(0 if len(results) > 0 and all(result.success for result in results) else 1)
+	if args.batch is not None:
+		results = batch.run_batch(args.batch, args.output_dir, args.jobs, options)
+		sys.exit(0 if len(results) > 0 and all(result.success for result in results) else 1)
+
 	print('====== RedPiano v{} ======'.format(VERSION))
 	print('RedPiano is open source and licensed under GPL-3.0: https://github.com/Fallen-Breath/RedPiano')
 	print()
-	with FakeStdOut.wrap():
+	echo = {'stdout': sys.stdout, 'stderr': sys.stderr, 'none': None}[args.echo]
+	with OutputSink.wrap(echo=echo, line_buffered=args.line_buffered):
 		try:
 			# dump_items()
-			process_sheet()
+			process_sheet(options)
 		except:
 			traceback.print_exc()
 			print('漏虫了，可能是输入有虫，也有可能是程序有虫，看看上面说啥')
@@ -78,4 +165,6 @@ def main():
 
 
 if __name__ == '__main__':
+	import multiprocessing
+	multiprocessing.freeze_support()
 	main()
@@ -0,0 +1,151 @@
+"""
+The item mapping, i.e. which minecraft item represents which note block symbol / time mark
+
+The mapping file is loaded lazily on first use and resolved into tuples indexed by the note / time mark,
+so importing the modules costs nothing and the lookups in the hot paths are plain index operations
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Tuple, Optional, Dict, List
+
+MAPPING_FILE_NAME = 'mapping.json'
+
+# note -1 (empty) ~ 24
+SYMBOL_NOTE_RANGE = range(-1, 25)
+# 4 bits time mark
+TIME_MARK_RANGE = range(16)
+
+
+class ItemMapping:
+	"""
+	The resolved item mapping. symbol[note + 1] and time_mark[time_mark] are the item ids
+	"""
+	__slots__ = ('path', 'symbol', 'time_mark', 'dummy', 'digest')
+
+	def __init__(self, path: str, symbol: Tuple[str, ...], time_mark: Tuple[str, ...], dummy: Tuple[str, ...], digest: str):
+		self.path = path
+		self.symbol = symbol
+		self.time_mark = time_mark
+		self.dummy = dummy
+		self.digest = digest  # sha256 of the resolved tables, for cache keys
+
+	def get_symbol_item(self, note: int) -> str:
+		return self.symbol[note + 1]
+
+	def get_time_mark_item(self, time_mark: int) -> str:
+		return self.time_mark[time_mark]
+
+	@classmethod
+	def from_dict(cls, data: dict, path: str) -> 'ItemMapping':
+		def resolve(key: str, indexes: range) -> Tuple[str, ...]:
+			table = data.get(key)
+			if not isinstance(table, dict):
+				raise ValueError('Missing "{}" in mapping file {}'.format(key, path))
+			try:
+				return tuple(str(table[str(i)]) for i in indexes)
+			except KeyError as e:
+				raise ValueError('Missing "{}" entry {} in mapping file {}'.format(key, e, path)) from None
+
+		symbol = resolve('symbol', SYMBOL_NOTE_RANGE)
+		time_mark = resolve('time_mark', TIME_MARK_RANGE)
+		dummy = data.get('dummy')
+		if not isinstance(dummy, list) or len(dummy) == 0:
+			raise ValueError('Missing "dummy" in mapping file {}'.format(path))
+		dummy = tuple(map(str, dummy))
+		digest = hashlib.sha256(json.dumps([symbol, time_mark, dummy]).encode('utf8')).hexdigest()
+		return ItemMapping(path, symbol, time_mark, dummy, digest)
+
+
+def _get_search_directories() -> List[str]:
+	directories = [os.getcwd()]
+	# next to the executable of the pyinstaller distribution, or next to the zipapp / main script
+	if getattr(sys, 'frozen', False):
+		directories.append(os.path.dirname(os.path.abspath(sys.executable)))
+	elif len(sys.argv) > 0 and sys.argv[0]:
+		directories.append(os.path.dirname(os.path.abspath(sys.argv[0])))
+	# the repository root when running from the source tree
+	directories.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	return directories
+
+
+def find_mapping_file() -> str:
+	"""
+	Search the mapping file in the working directory first so it can be overridden per project,
+	then next to the program, then in the source tree
+	"""
+	for directory in _get_search_directories():
+		path = os.path.join(directory, MAPPING_FILE_NAME)
+		if os.path.isfile(path):
+			return path
+	raise FileNotFoundError('Mapping file {} not found'.format(MAPPING_FILE_NAME))
+
+
+# (absolute path, mtime) -> mapping
+_loaded: Dict[Tuple[str, float], ItemMapping] = {}
+_current: Optional[ItemMapping] = None
+_lock = threading.Lock()
+# the mapping used by the current thread instead of _current, see use_mapping_file
+_local = threading.local()
+
+
+def load_mapping(path: str) -> ItemMapping:
+	"""
+	Load the given mapping file. Loaded files are cached until they are modified,
+	so switching between mapping files does not parse them again
+	"""
+	path = os.path.abspath(path)
+	key = (path, os.path.getmtime(path))
+	mapping = _loaded.get(key)
+	if mapping is None:
+		with open(path, encoding='utf8') as file:
+			mapping = ItemMapping.from_dict(json.load(file), path)
+		_loaded[key] = mapping
+	return mapping
+
+
+def set_mapping_file(path: Optional[str]):
+	"""
+	Use the given mapping file instead of the default one. None to restore the default one
+	The file is loaded right away, so an invalid file fails early
+	"""
+	global _current
+	with _lock:
+		_current = load_mapping(path) if path is not None else None
+
+
+def set_thread_mapping(mapping: Optional[ItemMapping]):
+	"""
+	Use the given mapping in the current thread instead of the process-wide one. None to use the process-wide one again
+	"""
+	_local.mapping = mapping
+
+
+@contextmanager
+def use_mapping_file(path: str):
+	"""
+	Use the given mapping file in the current thread within the context, without affecting other threads
+	"""
+	prev = getattr(_local, 'mapping', None)
+	set_thread_mapping(load_mapping(path))
+	try:
+		yield
+	finally:
+		set_thread_mapping(prev)
+
+
+def get_mapping() -> ItemMapping:
+	global _current
+	mapping = getattr(_local, 'mapping', None)
+	if mapping is not None:
+		return mapping
+	mapping = _current
+	if mapping is None:
+		with _lock:
+			if _current is None:
+				_current = load_mapping(find_mapping_file())
+			mapping = _current
+	return mapping
@@ -0,0 +1,136 @@
+import functools
+import re
+import struct
+from typing import BinaryIO, List, Optional
+
+TAG_END = 0
+TAG_BYTE = 1
+TAG_SHORT = 2
+TAG_INT = 3
+TAG_LONG = 4
+TAG_FLOAT = 5
+TAG_DOUBLE = 6
+TAG_BYTE_ARRAY = 7
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_INT_ARRAY = 11
+
+_SUPPLEMENTARY_PATTERN = re.compile('[\U00010000-\U0010FFFF]')
+
+
+@functools.lru_cache(maxsize=4096)
+def encode_string(text: str) -> bytes:
+	"""
+	Java's modified utf-8, used by NBT strings. The result is cached, since the tag names and item ids repeat a lot
+	"""
+	data = text.encode('utf8', 'surrogatepass')
+	# only NUL and the supplementary characters differ from utf-8, and they are rare
+	if b'\x00' not in data and not _SUPPLEMENTARY_PATTERN.search(text):
+		if len(data) > 0xFFFF:
+			raise ValueError('String too long for NBT: {} bytes'.format(len(data)))
+		return struct.pack('>H', len(data)) + data
+	data = bytearray()
+	for char in text:
+		code = ord(char)
+		if code == 0:
+			data += b'\xc0\x80'
+		elif code > 0xFFFF:
+			# supplementary characters are stored as a utf-8 encoded surrogate pair
+			code -= 0x10000
+			data += chr(0xD800 + (code >> 10)).encode('utf8', 'surrogatepass')
+			data += chr(0xDC00 + (code & 0x3FF)).encode('utf8', 'surrogatepass')
+		else:
+			data += char.encode('utf8', 'surrogatepass')
+	if len(data) > 0xFFFF:
+		raise ValueError('String too long for NBT: {} bytes'.format(len(data)))
+	return struct.pack('>H', len(data)) + data
+
+
+class NbtWriter:
+	"""
+	A streaming NBT encoder. Tags are written to the stream as soon as they are declared,
+	so the whole tree never needs to be built in memory
+
+	Inside a compound every tag needs a name. Inside a list the name must be None, and the element type and amount
+	of the list must be declared in advance with begin_list
+	"""
+	def __init__(self, stream: BinaryIO):
+		self.stream = stream
+		# for each opened list: [element type, remaining element amount]. None for compounds
+		self.__stack: List[Optional[list]] = []
+
+	def __write_header(self, tag_type: int, name: Optional[str]):
+		if len(self.__stack) > 0 and self.__stack[-1] is not None:
+			context = self.__stack[-1]
+			if name is not None or context[0] != tag_type:
+				raise ValueError('Expected an unnamed element of type {} in list, found {} {}'.format(context[0], tag_type, name))
+			if context[1] <= 0:
+				raise ValueError('Too many elements in list')
+			context[1] -= 1
+		else:
+			if name is None:
+				raise ValueError('Tag in compound needs a name')
+			self.stream.write(bytes((tag_type,)))
+			self.stream.write(encode_string(name))
+
+	def write_byte(self, name: Optional[str], value: int):
+		self.__write_header(TAG_BYTE, name)
+		self.stream.write(struct.pack('>b', value))
+
+	def write_short(self, name: Optional[str], value: int):
+		self.__write_header(TAG_SHORT, name)
+		self.stream.write(struct.pack('>h', value))
+
+	def write_int(self, name: Optional[str], value: int):
+		self.__write_header(TAG_INT, name)
+		self.stream.write(struct.pack('>i', value))
+
+	def write_long(self, name: Optional[str], value: int):
+		self.__write_header(TAG_LONG, name)
+		self.stream.write(struct.pack('>q', value))
+
+	def write_float(self, name: Optional[str], value: float):
+		self.__write_header(TAG_FLOAT, name)
+		self.stream.write(struct.pack('>f', value))
+
+	def write_double(self, name: Optional[str], value: float):
+		self.__write_header(TAG_DOUBLE, name)
+		self.stream.write(struct.pack('>d', value))
+
+	def write_string(self, name: Optional[str], value: str):
+		self.__write_header(TAG_STRING, name)
+		self.stream.write(encode_string(value))
+
+	def write_int_array(self, name: Optional[str], values: List[int]):
+		self.__write_header(TAG_INT_ARRAY, name)
+		self.stream.write(struct.pack('>i{}i'.format(len(values)), len(values), *values))
+
+	def begin_compound(self, name: Optional[str]):
+		self.__write_header(TAG_COMPOUND, name)
+		self.__stack.append(None)
+
+	def write_encoded_compound(self, name: Optional[str], content: bytes):
+		"""
+		Write a compound whose content is already encoded, e.g. by another writer, including the TAG_END
+		"""
+		self.__write_header(TAG_COMPOUND, name)
+		self.stream.write(content)
+
+	def end_compound(self):
+		if len(self.__stack) == 0 or self.__stack[-1] is not None:
+			raise ValueError('No compound to end')
+		self.__stack.pop()
+		self.stream.write(bytes((TAG_END,)))
+
+	def begin_list(self, name: Optional[str], element_type: int, length: int):
+		self.__write_header(TAG_LIST, name)
+		self.stream.write(struct.pack('>bi', element_type if length > 0 else TAG_END, length))
+		self.__stack.append([element_type, length])
+
+	def end_list(self):
+		if len(self.__stack) == 0 or self.__stack[-1] is None:
+			raise ValueError('No list to end')
+		if self.__stack[-1][1] != 0:
+			raise ValueError('{} elements of the list are not written'.format(self.__stack[-1][1]))
+		self.__stack.pop()
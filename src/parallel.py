@@ -0,0 +1,26 @@
+"""
+Executors for fanning the per-track jobs of a sheet out to multiple cores
+"""
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import mapping
+
+
+def is_free_threaded() -> bool:
+	"""
+	If the GIL is disabled, i.e. threads can run python code on multiple cores
+	"""
+	is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+	return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def create_executor(jobs: Optional[int] = None) -> Executor:
+	"""
+	A thread pool on free-threaded builds, otherwise a process pool whose workers use the same item mapping as this process
+	:param jobs: the amount of workers. None for the cpu count
+	"""
+	if is_free_threaded():
+		return ThreadPoolExecutor(max_workers=jobs, initializer=mapping.set_thread_mapping, initargs=(mapping.get_mapping(),))
+	return ProcessPoolExecutor(max_workers=jobs, initializer=mapping.set_mapping_file, initargs=(mapping.get_mapping().path,))
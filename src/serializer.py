@@ -1,8 +1,8 @@
 import copy
 from abc import ABC
-from enum import EnumMeta
+from enum import EnumMeta, Enum
 from threading import Lock
-from typing import Union, TypeVar, List, Dict, Type, get_type_hints
+from typing import Union, TypeVar, List, Dict, Type, get_type_hints, Any, Tuple, Callable, Optional
 
 T = TypeVar('T')
 
@@ -22,116 +22,289 @@ def _get_args(cls: Type) -> tuple:
 	return getattr(cls, '__args__', ())
 
 
-def serialize(obj) -> Union[None, int, float, str, list, dict]:
-	if type(obj) in (type(None), int, float, str, bool):
-		return obj
-	elif isinstance(obj, list) or isinstance(obj, tuple):
-		return list(map(serialize, obj))
-	elif isinstance(obj, dict):
-		return dict(map(lambda t: (t[0], serialize(t[1])), obj.items()))
-	elif isinstance(obj.__class__, EnumMeta):
-		return obj.name
+_IMMUTABLE_CLASSES = (type(None), bool, int, float, str, bytes, tuple, frozenset)
+
+
+class _ClassPlan:
+	"""
+	The pre-computed deserialization info of an object class, so the type hints are only resolved once per class
+	"""
+	def __init__(self, cls: Type):
+		self.cls = cls
+		# public field name -> field type
+		self.fields: Dict[str, Type] = {}
+		# public field name -> (class default value, whether it needs to be copied)
+		self.defaults: Dict[str, Tuple[Any, bool]] = {}
+		self.__field_deserializers: Optional[List[Tuple[str, Callable[[Any, bool, bool], Any]]]] = None
+		for attr_name, attr_type in _get_type_hints(cls).items():
+			if not attr_name.startswith('_'):
+				self.fields[attr_name] = attr_type
+				if hasattr(cls, attr_name):
+					value = getattr(cls, attr_name)
+					self.defaults[attr_name] = (value, not isinstance(value, _IMMUTABLE_CLASSES + (Enum,)))
+
+	def get_field_deserializers(self) -> List[Tuple[str, Callable[[Any, bool, bool], Any]]]:
+		# resolved lazily, in case the class refers to itself in its fields
+		if self.__field_deserializers is None:
+			self.__field_deserializers = [(attr_name, _get_deserializer(attr_type)[0]) for attr_name, attr_type in self.fields.items()]
+		return self.__field_deserializers
+
+	def new_instance(self):
+		try:
+			return self.cls()
+		except:
+			raise TypeError('Failed to construct instance of class {}'.format(type(self.cls)))
+
+	def set_default(self, inst, attr_name: str):
+		value, need_copy = self.defaults[attr_name]
+		inst.__setattr__(attr_name, copy.copy(value) if need_copy else value)
+
+	def create_default(self):
+		"""
+		Same as deserialize({}, cls), without the reflection cost
+		"""
+		inst = self.new_instance()
+		for attr_name in self.defaults.keys():
+			self.set_default(inst, attr_name)
+		if isinstance(inst, Serializable):
+			inst.on_deserialization()
+		return inst
+
+
+_class_plans: Dict[Type, _ClassPlan] = {}
+_class_plans_lock = Lock()
+
+
+def _get_class_plan(cls: Type) -> _ClassPlan:
+	plan = _class_plans.get(cls)
+	if plan is None:
+		with _class_plans_lock:
+			plan = _class_plans.get(cls)
+			if plan is None:
+				plan = _class_plans[cls] = _ClassPlan(cls)
+	return plan
+
+
+# ======================== Serialize ========================
+
+_Serializer = Callable[[Any], Any]
+# source class -> serializer
+_serializers: Dict[type, _Serializer] = {}
+
+
+def _serialize_list(obj) -> list:
+	return [_get_serializer(type(e))(e) for e in obj]
+
+
+def _serialize_dict(obj) -> dict:
+	return {key: _get_serializer(type(value))(value) for key, value in obj.items()}
+
+
+def _serialize_object(obj) -> dict:
 	try:
-		attr_dict = vars(obj).copy()
-		# don't serialize protected fields
-		for attr_name in list(attr_dict.keys()):
-			if attr_name.startswith('_'):
-				attr_dict.pop(attr_name)
+		attr_dict = vars(obj)
 	except:
 		raise TypeError('Unsupported input type {}'.format(type(obj))) from None
-	else:
-		return serialize(attr_dict)
+	# don't serialize protected fields
+	return {attr_name: _get_serializer(type(value))(value) for attr_name, value in attr_dict.items() if not attr_name.startswith('_')}
+
+
+def _make_serializer(obj_cls: type) -> _Serializer:
+	if obj_cls in (type(None), int, float, str, bool):
+		return lambda obj: obj
+	elif issubclass(obj_cls, (list, tuple)):
+		return _serialize_list
+	elif issubclass(obj_cls, dict):
+		return _serialize_dict
+	elif isinstance(obj_cls, EnumMeta):
+		return lambda obj: obj.name
+	return _serialize_object
+
 
+def _get_serializer(obj_cls: type) -> _Serializer:
+	serializer = _serializers.get(obj_cls)
+	if serializer is None:
+		serializer = _serializers[obj_cls] = _make_serializer(obj_cls)
+	return serializer
+
+
+def serialize(obj) -> Union[None, int, float, str, list, dict]:
+	return _get_serializer(type(obj))(obj)
+
+
+# ======================= Deserialize =======================
 
 _BASIC_CLASSES = (type(None), bool, int, float, str, list, dict)
 
+# (data, error_at_missing, error_at_redundancy) -> deserialized value
+_Deserializer = Callable[[Any, bool, bool], Any]
+# target class -> (deserializer, a cheap check on whether the data is in the shape the deserializer accepts)
+_deserializers: Dict[Any, Tuple[_Deserializer, Callable[[Any], bool]]] = {}
 
-def deserialize(data, cls: Type[T], *, error_at_missing=False, error_at_redundancy=False) -> T:
-	# in case None instead of NoneType is passed
-	if cls is None:
-		cls = type(None)
-	# Union
-	# Unpack Union first since the target class is not confirmed yet
-	if _get_origin(cls) == Union:
-		for possible_cls in _get_args(cls):
-			try:
-				return deserialize(data, possible_cls, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy)
-			except (TypeError, ValueError):
-				pass
+
+def _unsupported_input(cls, data):
+	return TypeError('Unsupported input type: expected class {} but found data with class {}'.format(cls, type(data)))
+
+
+def _make_union_deserializer(cls) -> Tuple[_Deserializer, Callable[[Any], bool]]:
+	candidates = [_get_deserializer(possible_cls) for possible_cls in _get_args(cls)]
+
+	def deserializer(data, error_at_missing: bool, error_at_redundancy: bool):
+		# only try the candidates whose data shape matches, so there's usually no failed attempt
+		for candidate, accepts in candidates:
+			if accepts(data):
+				try:
+					return candidate(data, error_at_missing, error_at_redundancy)
+				except (TypeError, ValueError):
+					pass
 		raise TypeError('Data in type {} cannot match any candidate of target class {}'.format(type(data), cls))
-	# Element (None, int, float, str, list, dict)
-	# For list and dict, since it doesn't have any type hint, we choose to simply return the data
-	elif cls in _BASIC_CLASSES and type(data) is cls:
-		return data
-	# float thing
-	elif cls is float and isinstance(data, int):
-		return float(data)
-	# List
-	elif _get_origin(cls) == List[int].__origin__ and isinstance(data, list):
-		element_type = _get_args(cls)[0]
-		return list(map(lambda e: deserialize(e, element_type, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy), data))
-	# Dict
-	elif _get_origin(cls) == Dict[int, int].__origin__ and isinstance(data, dict):
-		key_type = _get_args(cls)[0]
-		val_type = _get_args(cls)[1]
+
+	return deserializer, lambda data: any(accepts(data) for _, accepts in candidates)
+
+
+def _make_basic_deserializer(cls: type) -> Tuple[_Deserializer, Callable[[Any], bool]]:
+	if cls is float:
+		def accepts(data):
+			return type(data) is float or isinstance(data, int)
+
+		def deserializer(data, error_at_missing: bool, error_at_redundancy: bool):
+			if type(data) is float:
+				return data
+			elif isinstance(data, int):
+				return float(data)
+			raise _unsupported_input(cls, data)
+	else:
+		def accepts(data):
+			return type(data) is cls
+
+		# For list and dict, since it doesn't have any type hint, we choose to simply return the data
+		def deserializer(data, error_at_missing: bool, error_at_redundancy: bool):
+			if type(data) is cls:
+				return data
+			raise _unsupported_input(cls, data)
+	return deserializer, accepts
+
+
+def _make_list_deserializer(cls) -> Tuple[_Deserializer, Callable[[Any], bool]]:
+	args = _get_args(cls)
+	element_deserializer = _get_deserializer(args[0])[0] if len(args) > 0 else None
+
+	def deserializer(data, error_at_missing: bool, error_at_redundancy: bool):
+		if not isinstance(data, list):
+			raise _unsupported_input(cls, data)
+		if element_deserializer is None:
+			return data
+		return [element_deserializer(e, error_at_missing, error_at_redundancy) for e in data]
+
+	return deserializer, lambda data: isinstance(data, list)
+
+
+def _make_dict_deserializer(cls) -> Tuple[_Deserializer, Callable[[Any], bool]]:
+	args = _get_args(cls)
+	key_deserializer = _get_deserializer(args[0])[0] if len(args) > 0 else None
+	value_deserializer = _get_deserializer(args[1])[0] if len(args) > 1 else None
+
+	def deserializer(data, error_at_missing: bool, error_at_redundancy: bool):
+		if not isinstance(data, dict):
+			raise _unsupported_input(cls, data)
+		if key_deserializer is None:
+			return data
 		instance = {}
 		for key, value in data.items():
-			deserialized_key = deserialize(key, key_type, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy)
-			deserialized_value = deserialize(value, val_type, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy)
-			instance[deserialized_key] = deserialized_value
+			instance[key_deserializer(key, error_at_missing, error_at_redundancy)] = value_deserializer(value, error_at_missing, error_at_redundancy)
 		return instance
-	# Enum
-	elif isinstance(cls, EnumMeta) and isinstance(data, str):
+
+	return deserializer, lambda data: isinstance(data, dict)
+
+
+def _make_enum_deserializer(cls: EnumMeta) -> Tuple[_Deserializer, Callable[[Any], bool]]:
+	def deserializer(data, error_at_missing: bool, error_at_redundancy: bool):
+		if not isinstance(data, str):
+			raise _unsupported_input(cls, data)
 		return cls[data]
-	# Object
-	elif cls not in _BASIC_CLASSES and isinstance(cls, type) and isinstance(data, dict):
-		try:
-			result = cls()
-		except:
-			raise TypeError('Failed to construct instance of class {}'.format(type(cls)))
+
+	return deserializer, lambda data: isinstance(data, str) and data in cls.__members__
+
+
+def _make_object_deserializer(cls: type) -> Tuple[_Deserializer, Callable[[Any], bool]]:
+	plan = _get_class_plan(cls)
+
+	def deserializer(data, error_at_missing: bool, error_at_redundancy: bool):
+		if not isinstance(data, dict):
+			raise _unsupported_input(cls, data)
+		if len(data) == 0 and not error_at_missing:
+			return plan.create_default()
+		result = plan.new_instance()
 		input_key_set = set(data.keys())
-		for attr_name, attr_type in _get_type_hints(cls).items():
-			if not attr_name.startswith('_'):
-				if attr_name in data:
-					result.__setattr__(attr_name, deserialize(data[attr_name], attr_type, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy))
-					input_key_set.remove(attr_name)
-				elif error_at_missing:
-					raise ValueError('Missing attribute {} for class {} in input object {}'.format(attr_name, cls, data))
-				elif hasattr(cls, attr_name):
-					result.__setattr__(attr_name, copy.copy(getattr(cls, attr_name)))
+		for attr_name, field_deserializer in plan.get_field_deserializers():
+			if attr_name in data:
+				result.__setattr__(attr_name, field_deserializer(data[attr_name], error_at_missing, error_at_redundancy))
+				input_key_set.remove(attr_name)
+			elif error_at_missing:
+				raise ValueError('Missing attribute {} for class {} in input object {}'.format(attr_name, cls, data))
+			elif attr_name in plan.defaults:
+				plan.set_default(result, attr_name)
 		if error_at_redundancy and len(input_key_set) > 0:
 			raise ValueError('Redundancy attributes {} for class {} in input object {}'.format(input_key_set, cls, data))
 		if isinstance(result, Serializable):
 			result.on_deserialization()
 		return result
-	else:
-		raise TypeError('Unsupported input type: expected class {} but found data with class {}'.format(cls, type(data)))
 
+	return deserializer, lambda data: isinstance(data, dict)
 
-class Serializable(ABC):
-	__annotations_cache: dict = None
-	__annotations_lock = Lock()
 
+def _make_deserializer(cls) -> Tuple[_Deserializer, Callable[[Any], bool]]:
+	# Union
+	# Unpack Union first since the target class is not confirmed yet
+	if _get_origin(cls) == Union:
+		return _make_union_deserializer(cls)
+	# Element (None, int, float, str, list, dict)
+	elif cls in _BASIC_CLASSES:
+		return _make_basic_deserializer(cls)
+	# List
+	elif _get_origin(cls) == List[int].__origin__:
+		return _make_list_deserializer(cls)
+	# Dict
+	elif _get_origin(cls) == Dict[int, int].__origin__:
+		return _make_dict_deserializer(cls)
+	# Enum
+	elif isinstance(cls, EnumMeta):
+		return _make_enum_deserializer(cls)
+	# Object
+	elif isinstance(cls, type):
+		return _make_object_deserializer(cls)
+
+	def deserializer(data, error_at_missing: bool, error_at_redundancy: bool):
+		raise _unsupported_input(cls, data)
+
+	return deserializer, lambda data: False
+
+
+def _get_deserializer(cls) -> Tuple[_Deserializer, Callable[[Any], bool]]:
+	# in case None instead of NoneType is passed
+	if cls is None:
+		cls = type(None)
+	entry = _deserializers.get(cls)
+	if entry is None:
+		entry = _deserializers[cls] = _make_deserializer(cls)
+	return entry
+
+
+def deserialize(data, cls: Type[T], *, error_at_missing=False, error_at_redundancy=False) -> T:
+	return _get_deserializer(cls)[0](data, error_at_missing, error_at_redundancy)
+
+
+class Serializable(ABC):
 	def __init__(self, **kwargs):
+		fields = self.get_annotations_fields()
 		for key in kwargs.keys():
-			if key not in self.get_annotations_fields():
+			if key not in fields:
 				raise KeyError('Unknown key received in __init__ of class {}: {}'.format(self.__class__, key))
 		vars(self).update(kwargs)
 
-	@classmethod
-	def __get_annotation_dict(cls) -> dict:
-		public_fields = {}
-		for attr_name, attr_type in _get_type_hints(cls).items():
-			if not attr_name.startswith('_'):
-				public_fields[attr_name] = attr_type
-		return public_fields
-
 	@classmethod
 	def get_annotations_fields(cls) -> Dict[str, Type]:
-		with cls.__annotations_lock:
-			if cls.__annotations_cache is None:
-				cls.__annotations_cache = cls.__get_annotation_dict()
-		return cls.__annotations_cache
+		return _get_class_plan(cls).fields
 
 	def serialize(self) -> dict:
 		return serialize(self)
@@ -145,7 +318,7 @@ class Serializable(ABC):
 
 	@classmethod
 	def get_default(cls):
-		return cls.deserialize({})
+		return _get_class_plan(cls).create_default()
 
 	def on_deserialization(self):
 		"""
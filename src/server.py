@@ -0,0 +1,158 @@
+"""
+A resident compile server on localhost, so tools compiling lots of sheets don't pay the startup cost every time
+
+POST /compile  body: {"sheet": "<sheet text>", "compact": false}  -> the analysis and the commands of the sheet
+GET  /stats    -> request count and latency percentiles
+GET  /health   -> {"status": "ok"}
+"""
+import json
+import os
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, List, Tuple
+
+import mapping
+from compiler import CompileOptions, compile_sheet
+
+LATENCY_WINDOW = 10000
+PERCENTILES = (50, 90, 99)
+WARM_UP_SHEET = '短音\n1=C\n| 1 2 3 4 |\n'
+
+
+def _init_worker(options: CompileOptions):
+	# ctrl+c is handled by the server process, which shuts the pool down
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	if options.mapping_file is not None:
+		mapping.set_mapping_file(options.mapping_file)
+	# load the mapping and fill the lazy caches before the first request arrives
+	compile_request(WARM_UP_SHEET, options)
+
+
+def compile_request(content: str, options: CompileOptions) -> dict:
+	"""
+	Compile the sheet in a worker process
+	:return: a json-serializable dict of the results and the text output of the sheet, see CompileResult.to_dict
+	"""
+	start = time.time()
+	try:
+		compile_result = compile_sheet(content, options)
+	except Exception as e:
+		result = {'error': '{}: {}'.format(type(e).__name__, e)}
+	else:
+		result = compile_result.to_dict()
+		result['output'] = compile_result.render()
+	result['cost'] = time.time() - start
+	return result
+
+
+class LatencyStats:
+	"""
+	Latencies of the recent requests, thread-safe
+	"""
+	def __init__(self, window: int = LATENCY_WINDOW):
+		self.window = window
+		self.count = 0
+		self.error_count = 0
+		self.__latencies: List[float] = []
+		self.__lock = threading.Lock()
+
+	def record(self, seconds: float, error: bool):
+		with self.__lock:
+			self.count += 1
+			if error:
+				self.error_count += 1
+			self.__latencies.append(seconds)
+			if len(self.__latencies) > self.window:
+				del self.__latencies[:len(self.__latencies) - self.window]
+
+	def to_dict(self) -> dict:
+		with self.__lock:
+			latencies = sorted(self.__latencies)
+			data = {'count': self.count, 'error_count': self.error_count}
+		percentiles = {}
+		for p in PERCENTILES:
+			# nearest-rank percentile
+			percentiles['p{}'.format(p)] = latencies[max(0, (len(latencies) * p + 99) // 100 - 1)] if len(latencies) > 0 else None
+		data['latency_seconds'] = percentiles
+		data['latency_mean_seconds'] = sum(latencies) / len(latencies) if len(latencies) > 0 else None
+		return data
+
+
+class CompileServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address: Tuple[str, int], executor: ProcessPoolExecutor, options: CompileOptions):
+		super().__init__(address, CompileRequestHandler)
+		self.executor = executor
+		self.options = options
+		self.stats = LatencyStats()
+
+
+class CompileRequestHandler(BaseHTTPRequestHandler):
+	server: CompileServer
+
+	def log_message(self, format, *args):
+		pass
+
+	def __send_json(self, code: int, data: dict):
+		body = json.dumps(data, ensure_ascii=False).encode('utf8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if self.path == '/stats':
+			self.__send_json(200, self.server.stats.to_dict())
+		elif self.path == '/health':
+			self.__send_json(200, {'status': 'ok'})
+		else:
+			self.__send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+	def do_POST(self):
+		if self.path != '/compile':
+			self.__send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+			return
+		start = time.time()
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8'))
+			content = request['sheet']
+			if not isinstance(content, str):
+				raise ValueError('"sheet" should be a string')
+			compact = request.get('compact', self.server.options.compact)
+			if not isinstance(compact, bool):
+				raise ValueError('"compact" should be a boolean')
+			options = self.server.options._replace(compact=compact)
+		except (ValueError, KeyError, TypeError) as e:
+			self.__send_json(400, {'error': 'Bad request: {}'.format(e)})
+			return
+		try:
+			result = self.server.executor.submit(compile_request, content, options).result()
+		except Exception:
+			# the worker itself died, e.g. the process pool is broken
+			result = {'error': traceback.format_exc()}
+		result['latency'] = time.time() - start
+		self.server.stats.record(result['latency'], 'error' in result)
+		self.__send_json(200 if 'error' not in result else 422, result)
+
+
+def serve(host: str = '127.0.0.1', port: int = 8765, jobs: Optional[int] = None, options: CompileOptions = CompileOptions()):
+	# the default of ProcessPoolExecutor
+	workers = jobs or os.cpu_count() or 1
+	with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(options,)) as executor:
+		# spawn the workers and warm them up before accepting requests. The pool may spawn the workers on demand,
+		# so each of them needs a task
+		for future in [executor.submit(int) for _ in range(workers)]:
+			future.result()
+		with CompileServer((host, port), executor, options) as server:
+			print('编译服务器已启动: http://{}:{}'.format(*server.server_address[:2]))
+			try:
+				server.serve_forever()
+			except KeyboardInterrupt:
+				pass
+	print('编译服务器已关闭')
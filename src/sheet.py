@@ -1,10 +1,21 @@
 import collections
+import functools
+import hashlib
+import itertools
+import os
+import re
 from enum import Enum
-from typing import Optional, List, Dict, NamedTuple
+from typing import Optional, List, Dict, NamedTuple, Tuple, TYPE_CHECKING
 
-from item import ShulkerSheetStorage
+import instrument
+from cache import CompileCache
+from item import ShulkerSheetStorage, Item
 from symbol import NoteBlockSymbol, SheetSymbol
-from track import RedPianoTrack, RedPianoTrackItem, TimeMark
+from track import RedPianoTrack, RedPianoTrackItem, TimeMark, RedTrackAllocator, RedTrackBuilder, extend_tracks
+
+if TYPE_CHECKING:
+	# concurrent.futures is slow to import and only needed in parallel mode
+	from concurrent.futures import Executor
 
 
 class RhythmMode(Enum):
@@ -23,155 +34,441 @@ class RhythmMode(Enum):
 #   12 <-- Segment
 # 音段
 class Segment(NamedTuple):
-	text: str
+	symbols: Tuple[Optional[SheetSymbol], ...]  # None for the 延音符 -
+	offsets: Tuple[int, ...]  # offset of each symbol from the beginning of the segment
 	base_tonality: NoteBlockSymbol
+	line: int  # 1-based line number
+	column: int  # 1-based column of the beginning of the segment
+
+	def get_column(self, index: int) -> int:
+		return self.column + self.offsets[index]
 
 
 NoteBlockSymbolTrack = List[List[NoteBlockSymbol]]  # 音段 - 音符
 
+ALLOCATION_CHUNK_SIZE = 256  # amount of segments allocated and cached together by Sheet.process_time_mark
+
+_SEGMENT_PATTERN = re.compile(r'[^ \t]+')
+# tokens inside a segment, bar lines are ignored
+_SEGMENT_TOKEN_PATTERN = re.compile(r"(\|+)|(-)|([#Bb]?(\d)[,']?)|(.)")
+_BAR, _HOLD, _SYMBOL, _DIGIT, _UNKNOWN = range(1, 6)
+
+
+def format_position(line: int, column: int) -> str:
+	return '第{}行第{}列'.format(line, column)
+
+
+class _SegmentLexError(ValueError):
+	def __init__(self, offset: int, message: str):
+		super().__init__(message)
+		self.offset = offset
+
+
+@functools.lru_cache(maxsize=65536)
+def _lex_segment(text: str) -> Tuple[Tuple[Optional[SheetSymbol], ...], Tuple[int, ...]]:
+	"""
+	The same segments appear again and again in a sheet, so the result is cached
+	:return: (symbols, offsets), see Segment
+	"""
+	symbols: List[Optional[SheetSymbol]] = []
+	offsets: List[int] = []
+	for m in _SEGMENT_TOKEN_PATTERN.finditer(text):
+		kind = m.lastindex
+		if kind == _SYMBOL:
+			note = int(m.group(_DIGIT))
+			if note > 7:
+				raise _SegmentLexError(m.start(_DIGIT), '简谱数字{}超出了0~7范围'.format(note))
+			symbol = m.group(_SYMBOL)
+			prefix = symbol[0].upper() if symbol[0] in '#Bb' else ''
+			suffix = symbol[-1] if symbol[-1] in ",'" else ''
+			symbols.append(SheetSymbol(note, prefix, suffix))
+		elif kind == _HOLD:
+			symbols.append(None)
+		elif kind == _UNKNOWN:
+			raise _SegmentLexError(m.start(), '无法识别的简谱字符{}'.format(m.group()))
+		else:
+			continue
+		offsets.append(m.start())
+	return tuple(symbols), tuple(offsets)
+
+
+def tokenize_track_line(line: str, line_number: int, base_tonality: NoteBlockSymbol, end: Optional[int] = None) -> List[Segment]:
+	"""
+	Lex a 简谱 track line into segments of symbols
+	:param end: only lex line[:end], e.g. to exclude the comment
+	"""
+	segments: List[Segment] = []
+	for m in _SEGMENT_PATTERN.finditer(line, 0, len(line) if end is None else end):
+		try:
+			symbols, offsets = _lex_segment(m.group())
+		except _SegmentLexError as e:
+			raise ValueError('{}: {}'.format(format_position(line_number, m.start() + e.offset + 1), e)) from None
+		# a segment of bar lines only
+		if len(symbols) > 0:
+			segments.append(Segment(symbols, offsets, base_tonality, line_number, m.start() + 1))
+	return segments
+
+
+class SheetLineParser:
+	"""
+	Parses the sheet line by line, keeping the tonality / rhythm mode / track index state between lines
+	"""
+	def __init__(self):
+		self.tonality: Optional[NoteBlockSymbol] = None
+		self.rhythm_mode: RhythmMode = RhythmMode.short_tone
+		self.segments_id = 0
+		self.line_number = 0
+
+	def feed(self, line: str) -> Optional[Tuple[int, List[Segment]]]:
+		"""
+		:return: (index of the 简谱 track, segments of the line) if the line is a 简谱 track line, None otherwise
+		"""
+		self.line_number += 1
+		end = line.find('//')
+		if end == -1:
+			end = len(line)
+		if line.startswith('|'):
+			assert self.tonality is not None, '音高基准未声明，无法输入简谱音轨'
+			segments = tokenize_track_line(line, self.line_number, self.tonality, end)
+			track_index = self.segments_id
+			self.segments_id += 1
+			return track_index, segments
+		line = line[:end]
+		if line.startswith('1='):
+			self.tonality = NoteBlockSymbol.ofTonality(line[2:].upper())
+		rm = RhythmMode.guess_line(line)
+		if rm is not None:
+			self.rhythm_mode = rm
+		# 多个简谱音轨间用空行隔开
+		if len(line) == 0:
+			self.segments_id = 0
+		return None
+
+
+def translate_segment(segment: Segment, rhythm_mode: RhythmMode, prev_symbols: Optional[List[SheetSymbol]]) -> Tuple[List[SheetSymbol], List[NoteBlockSymbol], List[str]]:
+	"""
+	Translate a segment into note block symbols
+	:param prev_symbols: the sheet symbols of the previous segment, used by the 延音符 in long tone mode
+	:return: (sheet symbols, note block symbols, warning messages)
+	"""
+	symbols: List[SheetSymbol] = []
+	warnings: List[str] = []
+	prev_symbol: Optional[SheetSymbol]
+	long_tone = rhythm_mode == RhythmMode.long_tone
+	if long_tone:
+		prev_symbol = prev_symbols[-1] if prev_symbols is not None and len(prev_symbols) > 0 else None
+	else:
+		prev_symbol = SheetSymbol.empty()
+	for i, sheet_symbol in enumerate(segment.symbols):
+		if sheet_symbol is None:
+			if prev_symbol is None:
+				raise ValueError('{}: 延音符前方未找到音符'.format(format_position(segment.line, segment.get_column(i))))
+			sheet_symbol = prev_symbol
+		elif long_tone:
+			prev_symbol = sheet_symbol
+		symbols.append(sheet_symbol)
+	if len(symbols) not in (1, 2, 4):
+		raise ValueError('{}: 空格之间的简谱音符个数{}不合法'.format(format_position(segment.line, segment.column), len(symbols)))
+	noteblock_symbol_list: List[NoteBlockSymbol] = []
+	for sheet_symbol in symbols:
+		if sheet_symbol.is_empty():
+			noteblock_symbol = NoteBlockSymbol.empty()
+		else:
+			delta = sheet_symbol.get_delta()
+			try:
+				noteblock_symbol = segment.base_tonality.shift(delta, clamp=False)
+			except ValueError:
+				noteblock_symbol = segment.base_tonality.shift(delta, clamp=True)
+				warnings.append('[警告] 简谱音符{}于基调{}偏移{}后超出音符盒音符范围，使用边界值{}近似替代'.format(sheet_symbol, segment.base_tonality, delta, noteblock_symbol))
+		noteblock_symbol_list.append(noteblock_symbol)
+	return symbols, noteblock_symbol_list, warnings
+
+
+def translate_track(segments: List[Segment], rhythm_mode: RhythmMode, prev_symbols: Optional[List[SheetSymbol]]) -> Tuple[NoteBlockSymbolTrack, List[str]]:
+	"""
+	Translate all segments of a 简谱 track
+	:param prev_symbols: the sheet symbols before the track, see translate_segment
+	:return: (note block symbols of each segment, warning messages)
+	"""
+	noteblock_track: NoteBlockSymbolTrack = []
+	warnings: List[str] = []
+	for segment in segments:
+		prev_symbols, noteblock_symbol_list, segment_warnings = translate_segment(segment, rhythm_mode, prev_symbols)
+		warnings.extend(segment_warnings)
+		noteblock_track.append(noteblock_symbol_list)
+	return noteblock_track, warnings
+
+
+def get_last_symbol(segments: List[Segment], prev_symbol: Optional[SheetSymbol]) -> Optional[SheetSymbol]:
+	"""
+	The symbol a 延音符 right after the segments would continue in long tone mode, without translating them
+	:param prev_symbol: the symbol before the segments
+	"""
+	for segment in reversed(segments):
+		for symbol in reversed(segment.symbols):
+			if symbol is not None:
+				return symbol
+	return prev_symbol
+
+
+def collect_required_items(column: List[List[NoteBlockSymbol]], rhythm_mode: RhythmMode) -> List[RedPianoTrackItem]:
+	"""
+	Merge the note block symbols of the same segment in all 简谱 tracks into red piano track items
+	:param column: the note block symbols of the segment, one list per 简谱 track
+	"""
+	masks = TimeMark.LONG_TONE_MASKS if rhythm_mode == RhythmMode.long_tone else TimeMark.SHORT_TONE_MASKS
+	symbol2times: Dict[NoteBlockSymbol, int] = {}
+	for symbols in column:
+		for symbol, mask in zip(symbols, masks[len(symbols)]):
+			symbol2times[symbol] = symbol2times.get(symbol, 0) | mask
+	empty_symbol = NoteBlockSymbol.empty()
+	return [RedPianoTrackItem(symbol, time_mark) for symbol, time_mark in symbol2times.items() if symbol != empty_symbol]
+
+
+class StorageCommands(NamedTuple):
+	"""
+	The exported commands of a ShulkerSheetStorage
+	"""
+	shulker_amount: int
+	chest_commands: List[str]
+	compact: bool
+	shulker_command_sizes: List[int]  # byte size of the give command of each shulker, see StorageBuild.get_give_command_sizes
+
+
+class StorageUsage(NamedTuple):
+	stacks: int
+	shulkers: int
+
+
+def export_storage(storage: ShulkerSheetStorage, cache: Optional[CompileCache] = None) -> StorageCommands:
+	"""
+	Finish the storage and export it. With a cache given, unchanged storages reuse the commands of previous compiles
+	The command sizes are not recorded here since this may run in a worker process, see record_storage_commands
+	"""
+	key = cache.make_key('storage', storage.fingerprint()) if cache is not None else None
+	cached = cache.get('storage', key) if cache is not None else None
+	if cached is not None:
+		shulker_amount, chest_commands, shulker_command_sizes = cached['shulker_amount'], cached['chest_commands'], cached['shulker_command_sizes']
+	else:
+		build = storage.build()
+		chest_commands = build.get_chest_commands()
+		shulker_amount = build.shulker_amount
+		shulker_command_sizes = build.get_give_command_sizes()
+		if cache is not None:
+			cache.put('storage', key, {'shulker_amount': shulker_amount, 'chest_commands': chest_commands, 'shulker_command_sizes': shulker_command_sizes})
+	return StorageCommands(shulker_amount, chest_commands, storage.compact, shulker_command_sizes)
+
+
+def record_storage_commands(commands: StorageCommands):
+	"""
+	Record the sizes of the shulker and the chest commands into the instrumentation, also for the reused ones
+	"""
+	instrument.record_command_sizes('shulker', commands.shulker_command_sizes)
+	instrument.record_commands('chest', commands.chest_commands)
+
+
+def render_storage_commands(symbol_commands: StorageCommands, time_mark_commands: StorageCommands) -> List[str]:
+	"""
+	:return: the output lines of the commands of a red track
+	"""
+	lines = []
+	for label, (shulker_amount, commands, compact, _) in (('音符序列', symbol_commands), ('节奏序列', time_mark_commands)):
+		lines.append('{}需要{}个潜影盒:'.format(label, shulker_amount))
+		lines.append('\n'.join(commands))
+		if compact and len(commands) > 0:
+			lines.append('紧凑模式: {}个潜影盒装入{}条指令，平均每条指令{:.1f}个潜影盒'.format(shulker_amount, len(commands), shulker_amount / len(commands)))
+	lines.append('')
+	return lines
+
+
+def build_track_storages(index: int, track: RedPianoTrack, compact: bool, cache: Optional[CompileCache]) -> Tuple[Tuple[ShulkerSheetStorage, ShulkerSheetStorage], Tuple[StorageCommands, StorageCommands]]:
+	"""
+	Fill the symbol storage and the time mark storage of a red track and export them
+	:param index: 0-based index of the red track
+	:return: ((symbol storage, time mark storage), (symbol storage commands, time mark storage commands))
+	"""
+	storage_symbol = ShulkerSheetStorage('音轨#{}音符序列'.format(index + 1), compact)
+	storage_time_mark = ShulkerSheetStorage('音轨#{}节奏序列'.format(index + 1), compact)
+	# the storages only copy the fields of the items, so the items of the same track item are shared
+	items_cache: Dict[RedPianoTrackItem, Tuple[Item, Item]] = {}
+	for track_item, length in track.iter_runs():
+		items = items_cache.get(track_item)
+		if items is None:
+			items = items_cache[track_item] = track_item.to_items()
+		storage_symbol.add_item_run(items[0], length)
+		storage_time_mark.add_item_run(items[1], length)
+	return (storage_symbol, storage_time_mark), (export_storage(storage_symbol, cache), export_storage(storage_time_mark, cache))
+
+
+def build_track_storages_job(parent_pid: Optional[int], index: int, track: RedPianoTrack, compact: bool, cache: Optional[CompileCache]) -> Tuple[Tuple[Tuple[ShulkerSheetStorage, ShulkerSheetStorage], Tuple[StorageCommands, StorageCommands]], Optional[Dict[str, instrument.StageStat]]]:
+	"""
+	build_track_storages for an executor. The stages run in another process are recorded into a new instrumentation,
+	whose stage stats are returned for the parent to merge
+	:param parent_pid: the pid of the process collecting the instrumentation, None if it's disabled
+	:return: (result of build_track_storages, stage stats or None)
+	"""
+	if parent_pid is None or os.getpid() == parent_pid:
+		# serial, or worker threads sharing the instrumentation of the parent
+		return build_track_storages(index, track, compact, cache), None
+	instrumentation = instrument.Instrumentation(trace_memory=False)
+	with instrument.enable(instrumentation):
+		result = build_track_storages(index, track, compact, cache)
+	return result, instrumentation.stages
+
+
+def print_storage_commands(storage_symbol: ShulkerSheetStorage, storage_time_mark: ShulkerSheetStorage, cache: Optional[CompileCache] = None) -> Tuple[StorageCommands, StorageCommands]:
+	commands = export_storage(storage_symbol, cache), export_storage(storage_time_mark, cache)
+	for storage_commands in commands:
+		record_storage_commands(storage_commands)
+	print('\n'.join(render_storage_commands(*commands)))
+	return commands
+
 
 class Sheet:
+	"""
+	Compiles a sheet stage by stage. The stages only compute the results,
+	the human-readable output is rendered by CompileResult
+	"""
 	def __init__(self, rhythm_mode: RhythmMode, segments_list: List[List[Segment]]):
 		self.rhythm_mode: RhythmMode = rhythm_mode
 		self.segments_list: List[List[Segment]] = segments_list
 		self.noteblock_tracks: List[NoteBlockSymbolTrack] = []
+		# warning messages of the translation, filled by process_data
+		self.warnings: List[str] = []
 		self.red_tracks: List[RedPianoTrack] = []
+		# storage usage of the red tracks, and of the red tracks allocated in order, filled by process_time_mark
+		self.storage_usage = StorageUsage(0, 0)
+		self.naive_storage_usage = StorageUsage(0, 0)
+		# (symbol storage, time mark storage) of each red track, filled by generate_command
+		self.storages: List[Tuple[ShulkerSheetStorage, ShulkerSheetStorage]] = []
+		# (symbol storage commands, time mark storage commands) of each red track, filled by generate_command
+		self.commands: List[Tuple[StorageCommands, StorageCommands]] = []
 
 	@classmethod
+	@instrument.stage('Sheet.load')
 	def load(cls, content: str) -> 'Sheet':
 		segments_list: Dict[int, List[Segment]] = collections.defaultdict(list)
-		tonality = None
-		rhythm_mode = RhythmMode.short_tone
-		segments_id = 0
-		for line in content.upper().splitlines():
-			if '//' in line:
-				line = line.split('//')[0]
-			if line.startswith('1='):
-				tonality = NoteBlockSymbol.ofTonality(line[2:])
-			rm = RhythmMode.guess_line(line)
-			if rm is not None:
-				rhythm_mode = rm
-			if line.startswith('|'):
-				assert tonality is not None, '音高基准未声明，无法输入简谱音轨'
-				segments: List[Segment] = []
-				for segment in line.replace('|', '').replace('\t', ' ').split(' '):
-					if len(segment) > 0:
-						segments.append(Segment(segment, tonality))
-				segments_list[segments_id].extend(segments)
-				segments_id += 1
-			# 多个简谱音轨间用空行隔开
-			elif len(line) == 0:
-				segments_id = 0
+		parser = SheetLineParser()
+		for line in content.splitlines():
+			result = parser.feed(line)
+			if result is not None:
+				track_index, segments = result
+				segments_list[track_index].extend(segments)
 		assert len(segments_list) > 0, '未找到简谱音轨'
 		len_ = len(segments_list[0])
 		assert all(map(lambda lst: len(lst) == len_, segments_list.values())), '存在长度不一致的简谱音轨。简谱音轨长度列表为：{}'.format(' ,'.join(map(str, map(len, segments_list.values()))))
-		print('成功读取{}条简谱音轨，长度为{}'.format(len(segments_list), len_))
-		return Sheet(rhythm_mode, list(segments_list.values()))
+		return Sheet(parser.rhythm_mode, list(segments_list.values()))
 
 	@property
 	def segment_amount(self) -> int:
 		return len(self.segments_list[0])
 
-	def process_data(self):
-		print('节奏模式: {}'.format(self.rhythm_mode.value))
-		prev_symbols: Optional[List[SheetSymbol]] = None
-		warn_count = 0
-		for segments in self.segments_list:
-			noteblock_track: NoteBlockSymbolTrack = []
-			for segment in segments:
-				symbols: List[SheetSymbol] = []
-				prev_symbol: SheetSymbol
-				if self.rhythm_mode == RhythmMode.long_tone:
-					prev_symbol = prev_symbols[-1] if prev_symbols is not None and len(prev_symbols) > 0 else None
-				else:
-					prev_symbol = SheetSymbol.empty()
-				text = segment.text
-				while len(text) > 0:
-					try:
-						sheet_symbol, text = SheetSymbol.read(text, prev_symbol)
-					except Exception as e:
-						raise ValueError('从{}读取简谱音符失败: {}'.format(text, e))
-					if self.rhythm_mode == RhythmMode.long_tone:
-						prev_symbol = sheet_symbol
-					symbols.append(sheet_symbol)
-				assert len(symbols) in [1, 2, 4], '空格之间的简谱音符个数{}不合法'.format(len(symbols))
-				prev_symbols = symbols
-				noteblock_symbol_list: List[NoteBlockSymbol] = []
-				for sheet_symbol in symbols:
-					if sheet_symbol.is_empty():
-						noteblock_symbol = NoteBlockSymbol.empty()
-					else:
-						delta = sheet_symbol.get_delta()
-						try:
-							noteblock_symbol = segment.base_tonality.shift(delta, clamp=False)
-						except ValueError:
-							noteblock_symbol = segment.base_tonality.shift(delta, clamp=True)
-							print('[警告] 简谱音符{}于基调{}偏移{}后超出音符盒音符范围，使用边界值{}近似替代'.format(sheet_symbol, segment.base_tonality, delta, noteblock_symbol))
-							warn_count += 1
-					noteblock_symbol_list.append(noteblock_symbol)
-				noteblock_track.append(noteblock_symbol_list)
+	@instrument.stage('Sheet.process_data')
+	def process_data(self, executor: Optional['Executor'] = None):
+		"""
+		:param executor: translate the 简谱 tracks in parallel with it. The results are the same as the serial translation
+		"""
+		self.noteblock_tracks.clear()
+		self.warnings.clear()
+		# in long tone mode, a 延音符 at the beginning of a track continues the end of the previous track
+		prev_symbols_list: List[Optional[List[SheetSymbol]]] = [None]
+		for segments in self.segments_list[:-1]:
+			prev_symbols = prev_symbols_list[-1]
+			prev_symbols_list.append([get_last_symbol(segments, prev_symbols[-1] if prev_symbols is not None else None)])
+		args = (self.segments_list, itertools.repeat(self.rhythm_mode), prev_symbols_list)
+		for noteblock_track, warnings in map(translate_track, *args) if executor is None else executor.map(translate_track, *args):
 			self.noteblock_tracks.append(noteblock_track)
-		print('翻译后音符序列:')
-		for i, track in enumerate(self.noteblock_tracks):
-			print('简谱音轨#{}: '.format(i + 1) + ' '.join(map(lambda lst: '({})'.format(' '.join(map(str, lst))), track)))
-		if warn_count > 0:
-			print('##################')
-			print('>>> 警告: {}个 <<<'.format(warn_count))
-			print('##################')
-
-	def process_time_mark(self):
+			self.warnings.extend(warnings)
+
+	@instrument.stage('Sheet.process_time_mark')
+	def process_time_mark(self, cache: Optional[CompileCache] = None):
+		"""
+		Allocate the red tracks with RedTrackAllocator. The red tracks allocated in order are kept instead
+		if they need fewer item stacks
+		:param cache: with a cache given, the red tracks of each chunk of segments are reused if the chunk and
+		the red track items right before it are unchanged, so only the chunks from an edit on are allocated again
+		"""
+		allocator = RedTrackAllocator()
 		red_tracks: List[RedPianoTrack] = []
-		for idx in range(self.segment_amount):
-			required_items = []
-			symbol2times: Dict[NoteBlockSymbol, int] = collections.defaultdict(lambda: TimeMark.of('0000'))
-			for track in self.noteblock_tracks:
-				symbols: List[NoteBlockSymbol] = track[idx]
-				seg_len = {1: 4, 2: 2, 4: 1}[len(symbols)]
-				for i, symbol in enumerate(symbols):
-					len_1 = 1 if self.rhythm_mode == RhythmMode.short_tone else seg_len
-					len_prev_0 = seg_len * i
-					marker_text = ('0' * len_prev_0 + '1' * len_1).ljust(4, '0')
-					symbol2times[symbol] |= TimeMark.of(marker_text)
-
-			for symbol, time_mark in symbol2times.items():
-				if symbol != NoteBlockSymbol.empty():
-					required_items.append(RedPianoTrackItem(symbol, time_mark))
-
-			if len(red_tracks) < len(required_items):
-				for i in range(len(required_items) - len(red_tracks)):
-					track = RedPianoTrack()
-					for j in range(idx):
-						track.append(RedPianoTrackItem.empty())
-					red_tracks.append(track)
-			for i in range(len(red_tracks)):
-				item = required_items[i] if i < len(required_items) else RedPianoTrackItem.empty()
-				red_tracks[i].append(item)
+		naive_tracks: List[RedPianoTrack] = []
+		for start in range(0, self.segment_amount, ALLOCATION_CHUNK_SIZE):
+			end = min(start + ALLOCATION_CHUNK_SIZE, self.segment_amount)
+			chunk_tracks, naive_chunk_tracks = self.__allocate_chunk(allocator, start, end, cache)
+			extend_tracks(red_tracks, chunk_tracks, start, end - start)
+			extend_tracks(naive_tracks, naive_chunk_tracks, start, end - start)
 
 		self.red_tracks = red_tracks
-		print()
-		print('====== 音轨分析 ====== ')
-		print('共需要{}条红乐音轨'.format(len(red_tracks)))
-		for i, track in enumerate(red_tracks):
-			print('红乐音轨#{}'.format(i + 1))
-			print('  ' + ' '.join(map(lambda track_item: str(track_item.symbol).rjust(2, ' ').ljust(4, ' '), track)))
-			print('  ' + ' '.join(map(lambda track_item: str(track_item.time), track)))
-
-	def generate_command(self):
-		print()
-		print('====== 指令输出 ====== ')
-		for i, track in enumerate(self.red_tracks):
-			print('> 红乐音轨#{}'.format(i + 1))
-			storage_symbol = ShulkerSheetStorage('音轨#{}音符序列'.format(i + 1))
-			storage_time_mark = ShulkerSheetStorage('音轨#{}节奏序列'.format(i + 1))
-			for track_item in track:
-				storage_symbol.add_item(track_item.to_items()[0])
-				storage_time_mark.add_item(track_item.to_items()[1])
-			storage_symbol.done()
-			storage_time_mark.done()
-			cmd_s = storage_symbol.export_give_chest_command()
-			cmd_t = storage_time_mark.export_give_chest_command()
-			print('音符序列需要{}个潜影盒:'.format(len(storage_symbol.export_give_command())))
-			print('\n'.join(cmd_s))
-			print('节奏序列需要{}个潜影盒:'.format(len(storage_time_mark.export_give_command())))
-			print('\n'.join(cmd_t))
-			print()
+		self.storage_usage = self.__count_storage(red_tracks)
+		self.naive_storage_usage = self.__count_storage(naive_tracks)
+		if self.naive_storage_usage < self.storage_usage:
+			self.red_tracks, self.storage_usage = naive_tracks, self.naive_storage_usage
+
+	def __allocate_chunk(self, allocator: RedTrackAllocator, start: int, end: int, cache: Optional[CompileCache]) -> Tuple[List[RedPianoTrack], List[RedPianoTrack]]:
+		"""
+		Allocate the red tracks of the segments in [start, end)
+		:return: (red tracks, red tracks allocated in order) of the segments
+		"""
+		columns = [[track[idx] for track in self.noteblock_tracks] for idx in range(start, end)]
+		key = None
+		if cache is not None:
+			data = bytearray()
+			for column in columns:
+				for symbols in column:
+					data.append(len(symbols))
+					data.extend([symbol.note + 1 for symbol in symbols])
+			key = cache.make_key('red_tracks', self.rhythm_mode.name, str(len(self.noteblock_tracks)), ' '.join(map(str, allocator.last_items)), hashlib.sha256(data).hexdigest())
+			cached = cache.get('red_tracks', key)
+			if cached is not None:
+				chunk_tracks = [RedPianoTrack.from_runs(*runs) for runs in cached['red_tracks']]
+				allocator.last_items = [RedPianoTrackItem(NoteBlockSymbol(track.notes[-1]), track.time_marks[-1]) for track in chunk_tracks]
+				return chunk_tracks, [RedPianoTrack.from_runs(*runs) for runs in cached['naive_red_tracks']]
+
+		builder = RedTrackBuilder()
+		naive_builder = RedTrackBuilder()
+		for column in columns:
+			required_items = collect_required_items(column, self.rhythm_mode)
+			builder.append(allocator.allocate(required_items))
+			naive_builder.append(required_items)
+		chunk_tracks, naive_chunk_tracks = builder.build(), naive_builder.build()
+		if cache is not None:
+			cache.put('red_tracks', key, {
+				'red_tracks': [[track.notes.tolist(), track.time_marks.tolist(), track.lengths.tolist()] for track in chunk_tracks],
+				'naive_red_tracks': [[track.notes.tolist(), track.time_marks.tolist(), track.lengths.tolist()] for track in naive_chunk_tracks],
+			})
+		return chunk_tracks, naive_chunk_tracks
+
+	@classmethod
+	def __count_storage(cls, red_tracks: List[RedPianoTrack]) -> StorageUsage:
+		"""
+		:return: the item stacks and the shulkers needed to store the given red tracks
+		"""
+		stacks = 0
+		shulkers = 0
+		for track in red_tracks:
+			for stack_amount in track.count_stacks():
+				stacks += stack_amount
+				shulkers += (stack_amount + 26) // 27
+		return StorageUsage(stacks, shulkers)
+
+	@instrument.stage('Sheet.generate_command')
+	def generate_command(self, cache: Optional[CompileCache] = None, compact: bool = False, executor: Optional['Executor'] = None):
+		"""
+		:param executor: build the storages of the red tracks in parallel with it. The results are the same as the serial building
+		"""
+		self.storages.clear()
+		self.commands.clear()
+		amount = len(self.red_tracks)
+		args = (range(amount), self.red_tracks, itertools.repeat(compact, amount), itertools.repeat(cache, amount))
+		if executor is None:
+			results = ((result, None) for result in map(build_track_storages, *args))
+		else:
+			parent_pid = os.getpid() if instrument.get_current() is not None else None
+			results = executor.map(build_track_storages_job, itertools.repeat(parent_pid, amount), *args)
+		for (storages, commands), stages in results:
+			self.storages.append(storages)
+			self.commands.append(commands)
+			# recorded here since the workers can't record into the instrumentation of this process
+			for storage_commands in commands:
+				record_storage_commands(storage_commands)
+			if stages is not None:
+				instrument.merge_stages(stages)
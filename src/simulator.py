@@ -0,0 +1,267 @@
+"""
+A simulator of the red piano decoder, to verify the compiled results without building them in game
+
+The decoder reads one symbol item and one time mark item every 8gt, see resources/ref.md. The 8gt are split into
+4 sub-beats of 2gt, and the 4 bits of the time mark tell in which sub-beats the note block plays, highest bit first
+
+The timelines are stored as one big integer per note, whose i-th byte is the time mark played in the i-th segment,
+so they are built from whole runs of items and compared with a few bitwise operations instead of tick by tick
+"""
+import sys
+import time
+import traceback
+from typing import List, Dict, Tuple, NamedTuple, Optional, Iterable
+
+import instrument
+from compiler import CompileOptions, CompileResult, compile_sheet
+from item import ShulkerSheetStorage
+from mapping import get_mapping
+from sheet import RhythmMode, NoteBlockSymbolTrack
+from symbol import NoteBlockSymbol
+from track import RedPianoTrack, RedPianoTrackItem, TimeMark
+
+ITEM_TICKS = 8  # game ticks of an item, i.e. of a segment
+SUB_BEAT_TICKS = 2
+SUB_BEAT_AMOUNT = 4
+MAX_REPORTED_EVENTS = 5
+
+
+class NoteEvent(NamedTuple):
+	tick: int  # game ticks since the beginning of the song
+	note: int  # note block tunings, 0 ~ 24
+
+	@property
+	def segment(self) -> int:
+		return self.tick // ITEM_TICKS
+
+	@property
+	def sub_beat(self) -> int:
+		return self.tick % ITEM_TICKS // SUB_BEAT_TICKS
+
+	def __str__(self):
+		return '{}gt:{}'.format(self.tick, NoteBlockSymbol(self.note))
+
+
+class Timeline:
+	"""
+	The notes played in each sub-beat of a song. Notes played by multiple decoders at the same time are played once
+	"""
+	def __init__(self, length: int, masks: Optional[Dict[int, int]] = None):
+		self.length = length  # amount of segments
+		# note -> time marks of the note in all segments, one byte per segment
+		self.__masks: Dict[int, int] = {note: mask for note, mask in (masks or {}).items() if mask != 0}
+
+	def add_time_marks(self, note: int, time_marks: bytes):
+		"""
+		:param time_marks: the time mark of the note in each segment
+		"""
+		assert len(time_marks) <= self.length
+		mask = self.__masks.get(note, 0) | int.from_bytes(time_marks, 'little')
+		if mask != 0:
+			self.__masks[note] = mask
+
+	def get_time_marks(self, note: int) -> bytes:
+		return self.__masks.get(note, 0).to_bytes(self.length, 'little')
+
+	@property
+	def notes(self) -> List[int]:
+		return sorted(self.__masks.keys())
+
+	@property
+	def event_amount(self) -> int:
+		return sum(bin(mask).count('1') for mask in self.__masks.values())
+
+	def events(self) -> List[NoteEvent]:
+		"""
+		:return: all note events, ordered by tick then note
+		"""
+		result: List[NoteEvent] = []
+		for note in self.notes:
+			for segment, time_mark in enumerate(self.get_time_marks(note)):
+				if time_mark != 0:
+					for sub_beat in range(SUB_BEAT_AMOUNT):
+						if time_mark & (1 << (SUB_BEAT_AMOUNT - 1 - sub_beat)):
+							result.append(NoteEvent(segment * ITEM_TICKS + sub_beat * SUB_BEAT_TICKS, note))
+		result.sort()
+		return result
+
+	def difference(self, other: 'Timeline') -> 'Timeline':
+		"""
+		:return: the events in this timeline but not in the other one
+		"""
+		return Timeline(max(self.length, other.length), {note: mask & ~other.__masks.get(note, 0) for note, mask in self.__masks.items()})
+
+	def __eq__(self, other):
+		return isinstance(other, Timeline) and self.length == other.length and self.__masks == other.__masks
+
+	def __repr__(self):
+		return 'Timeline(length={}, events={})'.format(self.length, self.event_amount)
+
+
+@instrument.stage('simulator.simulate_sheet')
+def simulate_sheet(noteblock_tracks: List[NoteBlockSymbolTrack], rhythm_mode: RhythmMode) -> Timeline:
+	"""
+	The timeline the 简谱 tracks describe, i.e. the expected output of the decoders
+	"""
+	masks = TimeMark.LONG_TONE_MASKS if rhythm_mode == RhythmMode.long_tone else TimeMark.SHORT_TONE_MASKS
+	length = max(map(len, noteblock_tracks), default=0)
+	time_marks: Dict[int, bytearray] = {}
+	for track in noteblock_tracks:
+		for segment, symbols in enumerate(track):
+			for symbol, mask in zip(symbols, masks[len(symbols)]):
+				if not symbol.is_empty():
+					buffer = time_marks.get(symbol.note)
+					if buffer is None:
+						buffer = time_marks[symbol.note] = bytearray(length)
+					buffer[segment] |= mask
+	return Timeline(length, {note: int.from_bytes(buffer, 'little') for note, buffer in time_marks.items()})
+
+
+@instrument.stage('simulator.simulate_red_tracks')
+def simulate_red_tracks(red_tracks: List[RedPianoTrack]) -> Timeline:
+	"""
+	The timeline played by the decoders reading the red tracks, one decoder per red track
+	"""
+	timeline = Timeline(max(map(len, red_tracks), default=0))
+	for track in red_tracks:
+		# a decoder reads one item per segment, so the runs of a red track never overlap
+		time_marks: Dict[int, bytearray] = {}
+		position = 0
+		for note, time_mark, length in zip(track.notes, track.time_marks, track.lengths):
+			if note >= 0 and time_mark != 0:
+				buffer = time_marks.get(note)
+				if buffer is None:
+					buffer = time_marks[note] = bytearray(len(track))
+				buffer[position:position + length] = bytes((time_mark,)) * length
+			position += length
+		for note, buffer in time_marks.items():
+			timeline.add_time_marks(note, buffer)
+	return timeline
+
+
+def _read_storage(storage: ShulkerSheetStorage, item_values: Dict[str, int]) -> List[Tuple[int, int]]:
+	"""
+	:return: (value, amount) of each item stack in the storage, until the dummy padding
+	"""
+	dummy = set(get_mapping().dummy)
+	stacks: List[Tuple[int, int]] = []
+	for shulker in storage.build().shulkers:
+		for item in shulker.items:
+			if item.id in dummy:
+				return stacks
+			value = item_values.get(item.id)
+			if value is None:
+				raise ValueError('Unknown item {} in storage {}'.format(item.id, storage.name))
+			stacks.append((value, item.count))
+	return stacks
+
+
+@instrument.stage('simulator.decode_storages')
+def decode_storages(storage_symbol: ShulkerSheetStorage, storage_time_mark: ShulkerSheetStorage) -> RedPianoTrack:
+	"""
+	Read the items packed in the storages of a red track back, in the order the decoder reads them
+	"""
+	mapping = get_mapping()
+	symbol_stacks = _read_storage(storage_symbol, {item_id: i - 1 for i, item_id in enumerate(mapping.symbol)})
+	time_mark_stacks = _read_storage(storage_time_mark, {item_id: i for i, item_id in enumerate(mapping.time_mark)})
+	if sum(amount for _, amount in symbol_stacks) != sum(amount for _, amount in time_mark_stacks):
+		raise ValueError('Item amount mismatch between storage {} and {}'.format(storage_symbol.name, storage_time_mark.name))
+
+	# merge the item stacks of the 2 storages into runs of (symbol, time mark)
+	track = RedPianoTrack()
+	time_mark_iter = iter(time_mark_stacks)
+	time_mark, time_mark_amount = 0, 0
+	for note, amount in symbol_stacks:
+		while amount > 0:
+			if time_mark_amount == 0:
+				time_mark, time_mark_amount = next(time_mark_iter)
+			length = min(amount, time_mark_amount)
+			track.append_run(RedPianoTrackItem(NoteBlockSymbol(note), time_mark), length)
+			amount -= length
+			time_mark_amount -= length
+	return track
+
+
+def _describe_difference(title: str, difference: Timeline) -> str:
+	events = difference.events()
+	text = '{}{}个音符: '.format(title, len(events))
+	text += ', '.join('第{}段第{}拍{}'.format(event.segment + 1, event.sub_beat + 1, NoteBlockSymbol(event.note)) for event in events[:MAX_REPORTED_EVENTS])
+	if len(events) > MAX_REPORTED_EVENTS:
+		text += ' 等'
+	return text
+
+
+def compare_timelines(expected: Timeline, actual: Timeline, name: str) -> List[str]:
+	"""
+	:return: the error messages, empty if the same notes are played. Silence at the end is not compared
+	"""
+	errors = []
+	for title, difference in (('缺少', expected.difference(actual)), ('多出', actual.difference(expected))):
+		if difference.event_amount > 0:
+			errors.append(name + _describe_difference(title, difference))
+	return errors
+
+
+@instrument.stage('simulator.verify')
+def verify(result: CompileResult) -> List[str]:
+	"""
+	Replay the decoders with the red tracks and with the items packed in the storages,
+	and compare the played notes with the 简谱 tracks
+	:return: the error messages, empty if everything matches
+	"""
+	expected = simulate_sheet(result.noteblock_tracks, result.rhythm_mode)
+	errors = compare_timelines(expected, simulate_red_tracks(result.red_tracks), '红乐音轨')
+	decoded_tracks = []
+	for i, (storage_symbol, storage_time_mark) in enumerate(result.storages):
+		try:
+			decoded_tracks.append(decode_storages(storage_symbol, storage_time_mark))
+		except ValueError as e:
+			errors.append('红乐音轨#{}的潜影盒无法解码: {}'.format(i + 1, e))
+	if len(decoded_tracks) == len(result.storages):
+		errors.extend(compare_timelines(expected, simulate_red_tracks(decoded_tracks), '潜影盒物品序列'))
+	return errors
+
+
+class VerifyResult(NamedTuple):
+	path: str
+	cost: float
+	segment_amount: int
+	errors: List[str]
+
+	@property
+	def success(self) -> bool:
+		return len(self.errors) == 0
+
+
+def verify_sheet_file(path: str, options: CompileOptions = CompileOptions()) -> VerifyResult:
+	start = time.time()
+	segment_amount = 0
+	try:
+		with open(path, encoding='utf8') as f:
+			result = compile_sheet(f.read(), options)
+		segment_amount = result.segment_amount
+		errors = verify(result)
+	except Exception:
+		errors = [traceback.format_exc().rstrip().splitlines()[-1]]
+	return VerifyResult(path, time.time() - start, segment_amount, errors)
+
+
+def run_verify(paths: Iterable[str], options: CompileOptions = CompileOptions()) -> List[VerifyResult]:
+	"""
+	Compile the sheet files and verify each of them with the simulator, printing the results
+	"""
+	results = []
+	start = time.time()
+	for path in paths:
+		result = verify_sheet_file(path, options)
+		results.append(result)
+		if result.success:
+			print('[验证通过] {} ({}个音段, {:.2f}s)'.format(path, result.segment_amount, result.cost))
+		else:
+			print('[验证失败] {} ({:.2f}s)'.format(path, result.cost))
+			for error in result.errors:
+				print('  ' + error.replace('\n', '\n  '))
+	success_amount = sum(1 for result in results if result.success)
+	print('验证完成: {}个通过，{}个失败，总耗时{:.2f}s'.format(success_amount, len(results) - success_amount, time.time() - start))
+	sys.stdout.flush()
+	return results
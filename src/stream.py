@@ -0,0 +1,130 @@
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import instrument
+from cache import CompileCache
+from item import ShulkerSheetStorage
+from sheet import SheetLineParser, Segment, RhythmMode, translate_segment, collect_required_items, print_storage_commands
+from symbol import NoteBlockSymbol, SheetSymbol
+from track import RedPianoTrackItem, RedTrackAllocator
+
+
+class SheetStream:
+	"""
+	The streaming counterpart of Sheet
+
+	Lines are consumed lazily, and segments are yielded column by column as soon as every 简谱 track has got it,
+	so only the pending segments of the current block of tracks are kept in memory
+
+	Differences to Sheet:
+	- The rhythm mode needs to be declared before the first 简谱 track line
+	- In long tone mode, the 延音符 at the beginning of a 简谱 track continues the previous segment of the same track
+	"""
+	def __init__(self, lines: Iterable[str]):
+		self.lines = lines
+		self.rhythm_mode: RhythmMode = RhythmMode.short_tone
+		self.track_amount = 0
+		self.segment_amount = 0
+		self.red_track_amount = 0
+		# printed after the header like the non-stream output, only the warnings are kept
+		self.warnings: List[str] = []
+		# (symbol storage, time mark storage) of each red track, filled by generate_command
+		self.storages: List[Tuple[ShulkerSheetStorage, ShulkerSheetStorage]] = []
+
+	def iter_segment_columns(self) -> Iterator[List[Segment]]:
+		"""
+		:return: a generator yielding the segments at the same position of all 简谱 tracks
+		"""
+		parser = SheetLineParser()
+		pending: List[List[Segment]] = []
+
+		def flush_block() -> Iterator[List[Segment]]:
+			if self.track_amount == 0:
+				self.track_amount = len(pending)
+			assert len(pending) == self.track_amount, '存在数量不一致的简谱音轨段落，期望{}条，实际{}条'.format(self.track_amount, len(pending))
+			column_amount = min(map(len, pending))
+			for i in range(column_amount):
+				yield [track[i] for track in pending]
+			self.segment_amount += column_amount
+			for i in range(len(pending)):
+				pending[i] = pending[i][column_amount:]
+
+		for line in self.lines:
+			result = parser.feed(line.rstrip('\r\n'))
+			if parser.rhythm_mode != self.rhythm_mode:
+				assert self.segment_amount == 0 and len(pending) == 0, '流式处理要求节奏模式在简谱音轨之前声明'
+				self.rhythm_mode = parser.rhythm_mode
+			if result is not None:
+				track_index, segments = result
+				while len(pending) <= track_index:
+					pending.append([])
+				pending[track_index].extend(segments)
+			# a block of 简谱 tracks ends with an empty line
+			elif parser.segments_id == 0 and len(pending) > 0 and any(map(len, pending)):
+				yield from flush_block()
+		if len(pending) > 0:
+			yield from flush_block()
+		assert self.track_amount > 0, '未找到简谱音轨'
+		assert all(map(lambda lst: len(lst) == 0, pending)), '存在长度不一致的简谱音轨。剩余未对齐的音段数量为：{}'.format(' ,'.join(map(str, map(len, pending))))
+
+	def iter_noteblock_columns(self) -> Iterator[List[List[NoteBlockSymbol]]]:
+		"""
+		:return: a generator yielding the translated note block symbols of a segment, one list per 简谱 track
+		"""
+		prev_symbols_list: List[Optional[List[SheetSymbol]]] = []
+		for column in self.iter_segment_columns():
+			while len(prev_symbols_list) < len(column):
+				prev_symbols_list.append(None)
+			noteblock_column = []
+			for i, segment in enumerate(column):
+				prev_symbols_list[i], noteblock_symbol_list, warnings = translate_segment(segment, self.rhythm_mode, prev_symbols_list[i])
+				self.warnings.extend(warnings)
+				noteblock_column.append(noteblock_symbol_list)
+			yield noteblock_column
+
+	def iter_red_columns(self) -> Iterator[List[RedPianoTrackItem]]:
+		"""
+		:return: a generator yielding the red piano track items of a segment, one item per red track.
+		A red track that appears the first time in a column is considered to be filled with empty items for all previous segments
+		"""
+		allocator = RedTrackAllocator()
+		for column in self.iter_noteblock_columns():
+			items = allocator.allocate(collect_required_items(column, self.rhythm_mode))
+			self.red_track_amount = len(items)
+			yield items
+
+	@instrument.stage('SheetStream.generate_command')
+	def generate_command(self, cache: Optional[CompileCache] = None, compact: bool = False):
+		"""
+		Feed the red piano track items into the shulker storages as they are produced and print the commands at the end.
+		The output of the command section is the same as Sheet.generate_command, unless the red tracks allocated in order
+		need fewer item stacks, since the stream can't fall back to them after the items are fed
+		"""
+		storages = self.storages
+		storages.clear()
+		for idx, column in enumerate(self.iter_red_columns()):
+			while len(storages) < len(column):
+				i = len(storages)
+				storage_symbol = ShulkerSheetStorage('音轨#{}音符序列'.format(i + 1), compact)
+				storage_time_mark = ShulkerSheetStorage('音轨#{}节奏序列'.format(i + 1), compact)
+				empty_items = RedPianoTrackItem.empty().to_items()
+				storage_symbol.add_item_run(empty_items[0], idx)
+				storage_time_mark.add_item_run(empty_items[1], idx)
+				storages.append((storage_symbol, storage_time_mark))
+			for (storage_symbol, storage_time_mark), track_item in zip(storages, column):
+				items = track_item.to_items()
+				storage_symbol.add_item(items[0])
+				storage_time_mark.add_item(items[1])
+		print('成功读取{}条简谱音轨，长度为{}'.format(self.track_amount, self.segment_amount))
+		print('节奏模式: {}'.format(self.rhythm_mode.value))
+		for warning in self.warnings:
+			print(warning)
+		if len(self.warnings) > 0:
+			print('##################')
+			print('>>> 警告: {}个 <<<'.format(len(self.warnings)))
+			print('##################')
+		print('共需要{}条红乐音轨'.format(len(storages)))
+		print()
+		print('====== 指令输出 ====== ')
+		for i, (storage_symbol, storage_time_mark) in enumerate(storages):
+			print('> 红乐音轨#{}'.format(i + 1))
+			print_storage_commands(storage_symbol, storage_time_mark, cache)
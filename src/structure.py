@@ -0,0 +1,203 @@
+import functools
+import gzip
+import io
+import os
+from typing import List, Tuple, Iterator, Optional
+
+from item import ShulkerSheetStorage, Item, Container, Shulker, Chest, to_json_str
+from nbt import NbtWriter, TAG_COMPOUND, TAG_INT, TAG_END
+
+# 1.20.4, the last version using the Count / tag item format
+DEFAULT_DATA_VERSION = 3700
+CHEST_STATE = 'minecraft:chest[facing=south]'
+# max size of a structure on each axis that a structure block can save / load
+STRUCTURE_SIZE_LIMIT = 48
+
+StoragePair = Tuple[ShulkerSheetStorage, ShulkerSheetStorage]  # (symbol storage, time mark storage) of a red track
+
+
+def get_chest_amount(storage: ShulkerSheetStorage) -> int:
+	return (len(storage.get_shulkers()) + 26) // 27
+
+
+def make_chest(storage: ShulkerSheetStorage, index: int) -> Chest:
+	"""
+	The index-th chest of the storage, 27 shulkers per chest since there's no command length limit here
+	"""
+	shulkers = storage.get_shulkers()
+	chest = Chest.get_default()
+	chest.name = storage.name if get_chest_amount(storage) == 1 else '{}{}'.format(storage.name, index + 1)
+	# shallow copies with the slot in the chest, the shulkers of the storage are not modified
+	chest.items = [Shulker(items=shulker.items, count=1, slot=slot) for slot, shulker in enumerate(shulkers[index * 27:(index + 1) * 27])]
+	return chest
+
+
+def iter_chest_positions(storages: List[StoragePair], origin: Tuple[int, int] = (0, 0), size: Optional[int] = None) -> Iterator[Tuple[int, int, ShulkerSheetStorage, int]]:
+	"""
+	Red track i takes the rows z = 2i (symbol) and z = 2i + 1 (time mark). Chests face south and
+	have a 1 block gap on the x axis, so they never connect into double chests
+	:param origin: (x, z) of the area to list the chests in
+	:param size: the size of the square area on both axes. None for the whole layout
+	:return: a generator yielding (x, z, storage, chest index in the storage), relative to the origin
+	"""
+	origin_x, origin_z = origin
+	for i, pair in enumerate(storages):
+		for j, storage in enumerate(pair):
+			z = i * 2 + j - origin_z
+			if size is not None and not 0 <= z < size:
+				continue
+			chest_amount = get_chest_amount(storage)
+			# chest k is at x = 2k
+			start = (origin_x + 1) // 2
+			stop = min(chest_amount, (origin_x + size + 1) // 2) if size is not None else chest_amount
+			for k in range(start, stop):
+				yield k * 2 - origin_x, z, storage, k
+
+
+def iter_chest_layout(storages: List[StoragePair], origin: Tuple[int, int] = (0, 0), size: Optional[int] = None) -> Iterator[Tuple[int, int, Chest]]:
+	"""
+	See iter_chest_positions
+	:return: a generator yielding (x, z, chest), relative to the origin
+	"""
+	for x, z, storage, index in iter_chest_positions(storages, origin, size):
+		yield x, z, make_chest(storage, index)
+
+
+def get_structure_origins(storages: List[StoragePair]) -> List[Tuple[int, int]]:
+	"""
+	The layout is split into square areas that fit into a structure block
+	:return: the (x, z) origin of each non-empty area
+	"""
+	origins = set()
+	for i, pair in enumerate(storages):
+		for j, storage in enumerate(pair):
+			for k in range(get_chest_amount(storage)):
+				origins.add((k * 2 // STRUCTURE_SIZE_LIMIT * STRUCTURE_SIZE_LIMIT, (i * 2 + j) // STRUCTURE_SIZE_LIMIT * STRUCTURE_SIZE_LIMIT))
+	return sorted(origins, key=lambda origin: (origin[1], origin[0])) or [(0, 0)]
+
+
+def get_structure_path(file_path: str, origin: Tuple[int, int]) -> str:
+	"""
+	The file of the structure at the given origin, named with its offset from the first structure, e.g. output_48_0.nbt
+	"""
+	base, extension = os.path.splitext(file_path)
+	return '{}_{}_{}{}'.format(base, origin[0], origin[1], extension)
+
+
+def _to_text_component(name: str) -> str:
+	return to_json_str({'text': name}, compact=False)
+
+
+def _write_item_content(writer: NbtWriter, slot: int, id_: str, count: int, name: Optional[str], items: Optional[List[Item]]):
+	"""
+	The tags inside the compound of an item
+	:param items: the items inside, None if it's not a container
+	"""
+	writer.write_byte('Slot', slot)
+	writer.write_string('id', id_)
+	writer.write_byte('Count', count)
+	writer.begin_compound('tag')
+	if name is not None:
+		writer.begin_compound('display')
+		writer.write_string('Name', _to_text_component(name))
+		writer.end_compound()
+	if items is not None:
+		writer.begin_compound('BlockEntityTag')
+		_write_items(writer, items)
+		writer.end_compound()
+	writer.end_compound()
+
+
+@functools.lru_cache(maxsize=65536)
+def _encode_item_content(slot: int, id_: str, count: int, name: Optional[str]) -> bytes:
+	"""
+	The encoded content of the compound of an item that is not a container, including the TAG_END
+	"""
+	buffer = io.BytesIO()
+	_write_item_content(NbtWriter(buffer), slot, id_, count, name, None)
+	buffer.write(bytes((TAG_END,)))
+	return buffer.getvalue()
+
+
+def _write_item(writer: NbtWriter, item: Item):
+	if isinstance(item, Container):
+		writer.begin_compound(None)
+		_write_item_content(writer, item.slot, item.id, item.count, item.name, item.items)
+		writer.end_compound()
+	else:
+		# the same items fill most of the shulkers, so they are encoded only once
+		writer.write_encoded_compound(None, _encode_item_content(item.slot, item.id, item.count, item.name))
+
+
+def _write_items(writer: NbtWriter, items: List[Item]):
+	writer.begin_list('Items', TAG_COMPOUND, len(items))
+	for item in items:
+		_write_item(writer, item)
+	writer.end_list()
+
+
+def export_structure(storages: List[StoragePair], file_path: str, origin: Tuple[int, int] = (0, 0), data_version: int = DEFAULT_DATA_VERSION):
+	"""
+	Write the chests of all red tracks in an area into a gzip-compressed structure file, which can be loaded with a structure block
+	:param origin: (x, z) of the area, see get_structure_origins. The area is STRUCTURE_SIZE_LIMIT blocks wide on both axes
+	"""
+	# the amount of chests is needed in advance for the list headers
+	size_x, size_z, block_amount = 1, 1, 0
+	for x, z, _, _ in iter_chest_positions(storages, origin, STRUCTURE_SIZE_LIMIT):
+		size_x, size_z = max(size_x, x + 1), max(size_z, z + 1)
+		block_amount += 1
+	# encoded into memory first, since the encoder makes lots of tiny writes
+	buffer = io.BytesIO()
+	writer = NbtWriter(buffer)
+	writer.begin_compound('')
+	writer.write_int('DataVersion', data_version)
+	writer.begin_list('size', TAG_INT, 3)
+	for value in (size_x, 1, size_z):
+		writer.write_int(None, value)
+	writer.end_list()
+
+	writer.begin_list('palette', TAG_COMPOUND, 1)
+	writer.begin_compound(None)
+	writer.write_string('Name', 'minecraft:chest')
+	writer.begin_compound('Properties')
+	writer.write_string('facing', 'south')
+	writer.write_string('type', 'single')
+	writer.write_string('waterlogged', 'false')
+	writer.end_compound()
+	writer.end_compound()
+	writer.end_list()
+
+	writer.begin_list('blocks', TAG_COMPOUND, block_amount)
+	for x, z, chest in iter_chest_layout(storages, origin, STRUCTURE_SIZE_LIMIT):
+		writer.begin_compound(None)
+		writer.write_int('state', 0)
+		writer.begin_list('pos', TAG_INT, 3)
+		for value in (x, 0, z):
+			writer.write_int(None, value)
+		writer.end_list()
+		writer.begin_compound('nbt')
+		writer.write_string('id', 'minecraft:chest')
+		writer.write_string('CustomName', _to_text_component(chest.name))
+		_write_items(writer, chest.items)
+		writer.end_compound()
+		writer.end_compound()
+	writer.end_list()
+
+	writer.begin_list('entities', TAG_END, 0)
+	writer.end_list()
+	writer.end_compound()
+
+	# the path may be a temporary file, so no file name is stored in the gzip header
+	with open(file_path, 'wb') as raw_file, gzip.GzipFile(filename='', mode='wb', fileobj=raw_file) as file:
+		file.write(buffer.getbuffer())
+
+
+def export_mcfunction(storages: List[StoragePair], file_path: str):
+	"""
+	Write a datapack function that places the chests of all red tracks around the executor with /setblock,
+	with the same layout as the structure file. Function commands have no length limit, so every chest holds 27 shulkers
+	"""
+	with open(file_path, 'w', encoding='utf8') as file:
+		for x, z, chest in iter_chest_layout(storages):
+			nbt = '{"CustomName":' + to_json_str(_to_text_component(chest.name)) + ',"Items":[' + ','.join([item.to_json() for item in chest.items]) + ']}'
+			file.write('setblock ~{} ~ ~{} {}{}\n'.format(x, z, CHEST_STATE, nbt))
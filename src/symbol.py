@@ -1,24 +1,44 @@
-from typing import Dict, Tuple, Optional
+import re
+from typing import Dict, Tuple
 
 
 class NoteBlockSymbol:
+	"""
+	Immutable and interned, so there's only one instance for each note
+	"""
+	__slots__ = ('note', 'symbol', '__str', '__hash')
+
 	note: int
 
 	__MAPPING: Dict[int, str] = {0: 'F#', 1: 'G', 2: 'G#', 3: 'A', 4: 'A#', 5: 'B', 6: 'C', 7: 'C#', 8: 'D', 9: 'D#', 10: 'E', 11: 'F', 12: 'F#', 13: 'G', 14: 'G#', 15: 'A', 16: 'A#', 17: 'B', 18: 'C', 19: 'C#', 20: 'D', 21: 'D#', 22: 'E', 23: 'F', 24: 'F#'}
+	__INSTANCES: Dict[int, 'NoteBlockSymbol'] = {}
+
+	def __new__(cls, note: int):
+		inst = cls.__INSTANCES.get(note)
+		if inst is None:
+			assert -1 <= note <= 24
+			inst = super().__new__(cls)
+			object.__setattr__(inst, 'note', note)
+			object.__setattr__(inst, 'symbol', cls.__MAPPING.get(note))
+			object.__setattr__(inst, '_NoteBlockSymbol__str', '{}_{}'.format(note, inst.symbol) if note != -1 else 'X')
+			object.__setattr__(inst, '_NoteBlockSymbol__hash', hash(note))
+			cls.__INSTANCES[note] = inst
+		return inst
+
+	def __setattr__(self, key, value):
+		raise AttributeError('{} is immutable'.format(type(self).__name__))
 
-	def __init__(self, note: int):
-		assert -1 <= note <= 24
-		self.note = note
-		self.symbol = self.__MAPPING.get(self.note)
+	def __reduce__(self):
+		return type(self), (self.note,)
 
 	def __str__(self):
-		return '{}_{}'.format(self.note, self.symbol) if not self.is_empty() else 'X'
+		return self.__str
 
 	def __eq__(self, other):
-		return isinstance(other, type(self)) and self.note == other.note
+		return self is other or (isinstance(other, type(self)) and self.note == other.note)
 
 	def __hash__(self):
-		return hash(self.note)
+		return self.__hash
 
 	def is_empty(self) -> bool:
 		return self.note == -1
@@ -53,62 +73,79 @@ class NoteBlockSymbol:
 
 
 class SheetSymbol:
+	"""
+	Immutable and interned, so there's only one instance for each (note, prefix, suffix)
+	"""
+	__slots__ = ('note', 'prefix', 'suffix', '__str', '__hash', '__delta')
+
 	note: int  # 0, 1 ~ 7
 	prefix: str  # 数字前的升降记号   #b
 	suffix: str  # 数字后的跨八度符号 ,'
 
 	__NOTE_DELTA: Dict[int, int] = {1: 0, 2: 2, 3: 4, 4: 5, 5: 7, 6: 9, 7: 11}
+	# any decimal digit like the track lexer, e.g. full-width digits, the range is checked separately
+	__PATTERN = re.compile(r"([#B]?)(\d)([,']?)")
+	__INSTANCES: Dict[Tuple[int, str, str], 'SheetSymbol'] = {}
+
+	def __new__(cls, note: int, prefix: str, suffix: str):
+		key = (note, prefix, suffix)
+		inst = cls.__INSTANCES.get(key)
+		if inst is None:
+			inst = super().__new__(cls)
+			object.__setattr__(inst, 'note', note)
+			object.__setattr__(inst, 'prefix', prefix)
+			object.__setattr__(inst, 'suffix', suffix)
+			object.__setattr__(inst, '_SheetSymbol__str', '{}{}{}'.format(prefix, note, suffix))
+			object.__setattr__(inst, '_SheetSymbol__hash', hash(key))
+			object.__setattr__(inst, '_SheetSymbol__delta', cls.__calc_delta(note, prefix, suffix) if note != 0 else None)
+			cls.__INSTANCES[key] = inst
+		return inst
 
-	def __init__(self, note: int, prefix: str, suffix: str):
-		self.note = note
-		self.prefix = prefix
-		self.suffix = suffix
+	def __setattr__(self, key, value):
+		raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+	def __reduce__(self):
+		return type(self), (self.note, self.prefix, self.suffix)
 
 	def __str__(self):
-		return '{}{}{}'.format(self.prefix, self.note, self.suffix)
+		return self.__str
 
-	@classmethod
-	def read(cls, text: str, prev_symbol: Optional['SheetSymbol'] = None) -> Tuple['SheetSymbol', str]:
-		prefix = ''
-		suffix = ''
-		if not text[0].isdigit():
-			prefix = text[0]
-			text = text[1:]
-			if prefix == '-':
-				assert prev_symbol is not None, '延音符前方未找到音符'
-				return prev_symbol, text
-			assert prefix in '#B', '非法升降记号前缀{}'.format(prefix)
-		assert len(text) > 0 and text[0].isdigit(), '剩余字符串{}首字母不是数字'.format(text)
-		note = int(text[0])
-		text = text[1:]
-		assert 0 <= note <= 7, '简谱数字{}超出了0~7范围'.format(note)
-		if len(text) > 0 and text[0] in ",'":
-			suffix = text[0]
-			text = text[1:]
-		return cls(note, prefix, suffix), text
+	def __eq__(self, other):
+		return self is other or (isinstance(other, type(self)) and (self.note, self.prefix, self.suffix) == (other.note, other.prefix, other.suffix))
+
+	def __hash__(self):
+		return self.__hash
 
 	@classmethod
 	def of(cls, text: str) -> 'SheetSymbol':
-		inst, rest = cls.read(text)
-		assert len(rest) == 0
-		return inst
+		match = cls.__PATTERN.fullmatch(text.upper())
+		if match is None:
+			raise ValueError('非法简谱音符{}'.format(text))
+		note = int(match.group(2))
+		if note > 7:
+			raise ValueError('简谱数字{}超出了0~7范围'.format(note))
+		return cls(note, match.group(1), match.group(3))
 
 	@classmethod
 	def empty(cls) -> 'SheetSymbol':
-		return cls.of('0')
+		return cls(0, '', '')
 
 	def is_empty(self) -> bool:
 		return self.note == 0
 
-	def get_delta(self) -> int:
-		assert not self.is_empty()
-		delta = self.__NOTE_DELTA[self.note]
-		if self.prefix == '#':
+	@classmethod
+	def __calc_delta(cls, note: int, prefix: str, suffix: str) -> int:
+		delta = cls.__NOTE_DELTA[note]
+		if prefix == '#':
 			delta += 1
-		elif self.prefix == 'B':
+		elif prefix == 'B':
 			delta -= 1
-		if self.suffix == "'":
+		if suffix == "'":
 			delta += 12
-		elif self.suffix == ',':
+		elif suffix == ',':
 			delta -= 12
 		return delta
+
+	def get_delta(self) -> int:
+		assert not self.is_empty()
+		return self.__delta
@@ -1,10 +1,25 @@
-from typing import List, Tuple
+import itertools
+from array import array
+from typing import List, Tuple, Dict, Optional, Iterable, Iterator
 
-from item import Item, MAPPING_DATA
+from item import Item, ITEM_STACK_LIMIT
+from mapping import get_mapping
 from symbol import NoteBlockSymbol
 
 
 class TimeMark:
+	# amount of symbols in a segment -> time mark of each symbol, as the 4-bit mask of the 4 sub-beats
+	SHORT_TONE_MASKS: Dict[int, Tuple[int, ...]] = {
+		1: (0b1000,),
+		2: (0b1000, 0b0010),
+		4: (0b1000, 0b0100, 0b0010, 0b0001),
+	}
+	LONG_TONE_MASKS: Dict[int, Tuple[int, ...]] = {
+		1: (0b1111,),
+		2: (0b1100, 0b0011),
+		4: (0b1000, 0b0100, 0b0010, 0b0001),
+	}
+
 	@classmethod
 	def is_valid(cls, value: int) -> bool:
 		return 0 <= value <= 15
@@ -17,31 +32,294 @@ class TimeMark:
 
 
 class RedPianoTrackItem:
+	"""
+	Immutable and interned, so there's only one instance for each (symbol, time mark)
+	"""
+	__slots__ = ('symbol', '__time_mark', '__time', '__str', '__hash')
+
 	symbol: NoteBlockSymbol
 	__time_mark: int
 
-	def __init__(self, symbol: NoteBlockSymbol, time_mark: int):
-		self.symbol = symbol
-		assert TimeMark.is_valid(time_mark)
-		self.__time_mark = time_mark
+	__INSTANCES: Dict[Tuple[NoteBlockSymbol, int], 'RedPianoTrackItem'] = {}
+
+	def __new__(cls, symbol: NoteBlockSymbol, time_mark: int):
+		key = (symbol, time_mark)
+		inst = cls.__INSTANCES.get(key)
+		if inst is None:
+			assert TimeMark.is_valid(time_mark)
+			inst = super().__new__(cls)
+			time = bin(time_mark)[2:].rjust(4, '0')
+			object.__setattr__(inst, 'symbol', symbol)
+			object.__setattr__(inst, '_RedPianoTrackItem__time_mark', time_mark)
+			object.__setattr__(inst, '_RedPianoTrackItem__time', time)
+			object.__setattr__(inst, '_RedPianoTrackItem__str', '{}@{}'.format(symbol, time))
+			object.__setattr__(inst, '_RedPianoTrackItem__hash', hash(key))
+			cls.__INSTANCES[key] = inst
+		return inst
+
+	def __setattr__(self, key, value):
+		raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+	def __reduce__(self):
+		return type(self), (self.symbol, self.__time_mark)
+
+	def __eq__(self, other):
+		return self is other or (isinstance(other, type(self)) and self.symbol == other.symbol and self.__time_mark == other.__time_mark)
+
+	def __hash__(self):
+		return self.__hash
 
 	@property
 	def time(self) -> str:
-		return bin(self.__time_mark)[2:].rjust(4, '0')
+		return self.__time
+
+	@property
+	def time_mark(self) -> int:
+		return self.__time_mark
 
 	@classmethod
 	def empty(cls) -> 'RedPianoTrackItem':
 		return RedPianoTrackItem(NoteBlockSymbol.empty(), 0)
 
 	def __str__(self):
-		return '{}@{}'.format(self.symbol, self.time)
+		return self.__str
 
 	def to_items(self) -> Tuple[Item, Item]:
+		# new items every time since they are mutable
+		mapping = get_mapping()
 		return (
-			Item(id=MAPPING_DATA['symbol'][str(self.symbol.note)], name=str(self.symbol), count=1),
-			Item(id=MAPPING_DATA['time_mark'][str(self.__time_mark)], name=self.time, count=1),
+			Item(id=mapping.symbol[self.symbol.note + 1], name=str(self.symbol), count=1),
+			Item(id=mapping.time_mark[self.__time_mark], name=self.__time, count=1),
 		)
 
 
-class RedPianoTrack(List[RedPianoTrackItem]):
-	pass
+class RedPianoTrack:
+	"""
+	The items of a red track, run-length encoded into arrays: the note (int8) and the time mark (uint8) of each run
+	of identical items, and the length of the run. The empty padding and repeated items only cost a single run
+	"""
+	def __init__(self, items: Iterable[RedPianoTrackItem] = ()):
+		self.notes = array('b')
+		self.time_marks = array('B')
+		self.lengths = array('L')
+		self.__length = 0
+		for item in items:
+			self.append(item)
+
+	@classmethod
+	def empty(cls, length: int) -> 'RedPianoTrack':
+		track = cls()
+		track.append_run(RedPianoTrackItem.empty(), length)
+		return track
+
+	@classmethod
+	def from_runs(cls, notes: Iterable[int], time_marks: Iterable[int], lengths: Iterable[int]) -> 'RedPianoTrack':
+		"""
+		Create a track from the arrays of the runs as is, see the notes, time_marks and lengths fields
+		"""
+		track = cls()
+		track.notes = array('b', notes)
+		track.time_marks = array('B', time_marks)
+		track.lengths = array('L', lengths)
+		if not len(track.notes) == len(track.time_marks) == len(track.lengths):
+			raise ValueError('The run arrays should have the same length')
+		track.__length = sum(track.lengths)
+		return track
+
+	def append_run(self, item: RedPianoTrackItem, length: int):
+		if length <= 0:
+			return
+		note = item.symbol.note
+		time_mark = item.time_mark
+		if len(self.lengths) > 0 and self.notes[-1] == note and self.time_marks[-1] == time_mark:
+			self.lengths[-1] += length
+		else:
+			self.notes.append(note)
+			self.time_marks.append(time_mark)
+			self.lengths.append(length)
+		self.__length += length
+
+	def append(self, item: RedPianoTrackItem):
+		self.append_run(item, 1)
+
+	def extend(self, other: 'RedPianoTrack'):
+		"""
+		Append the runs of the other track at the end
+		"""
+		if other.run_amount == 0:
+			return
+		start = 0
+		if len(self.lengths) > 0 and self.notes[-1] == other.notes[0] and self.time_marks[-1] == other.time_marks[0]:
+			self.lengths[-1] += other.lengths[0]
+			start = 1
+		self.notes.extend(other.notes[start:])
+		self.time_marks.extend(other.time_marks[start:])
+		self.lengths.extend(other.lengths[start:])
+		self.__length += len(other)
+
+	def __len__(self):
+		return self.__length
+
+	@property
+	def run_amount(self) -> int:
+		return len(self.lengths)
+
+	def iter_runs(self) -> Iterator[Tuple[RedPianoTrackItem, int]]:
+		"""
+		:return: a generator yielding (item, length) of each run
+		"""
+		for note, time_mark, length in zip(self.notes, self.time_marks, self.lengths):
+			yield RedPianoTrackItem(NoteBlockSymbol(note), time_mark), length
+
+	def __iter__(self) -> Iterator[RedPianoTrackItem]:
+		for item, length in self.iter_runs():
+			yield from itertools.repeat(item, length)
+
+	def count_stacks(self) -> Tuple[int, int]:
+		"""
+		:return: the amount of item stacks of the symbol items and the time mark items,
+		i.e. the amount of slots needed in ShulkerSheetStorage
+		"""
+		def count(keys: Iterable[int]) -> int:
+			stacks = 0
+			prev_key = None
+			size = 0
+			# runs with the same key are stacked together
+			for key, length in zip(keys, self.lengths):
+				if key != prev_key:
+					stacks += (size + ITEM_STACK_LIMIT - 1) // ITEM_STACK_LIMIT
+					size = 0
+				prev_key = key
+				size += length
+			return stacks + (size + ITEM_STACK_LIMIT - 1) // ITEM_STACK_LIMIT
+
+		return count(self.notes), count(self.time_marks)
+
+
+class RedTrackBuilder:
+	"""
+	Builds the red tracks from the items of each segment, appending a whole run to the tracks when the item changes
+	"""
+	def __init__(self):
+		self.tracks: List[RedPianoTrack] = []
+		self.__segment_amount = 0
+		# the item of the current run of each track, and its length
+		self.__items: List[RedPianoTrackItem] = []
+		self.__lengths: List[int] = []
+
+	def append(self, items: List[RedPianoTrackItem]):
+		"""
+		:param items: the item of each red track in the segment. Missing items are empty, and new red tracks are
+		considered to be filled with empty items for all previous segments
+		"""
+		empty = RedPianoTrackItem.empty()
+		while len(self.tracks) < len(items):
+			self.tracks.append(RedPianoTrack())
+			self.__items.append(empty)
+			self.__lengths.append(self.__segment_amount)
+		for i, item in enumerate(itertools.chain(items, itertools.repeat(empty, len(self.tracks) - len(items)))):
+			if item is self.__items[i]:
+				self.__lengths[i] += 1
+			else:
+				self.tracks[i].append_run(self.__items[i], self.__lengths[i])
+				self.__items[i] = item
+				self.__lengths[i] = 1
+		self.__segment_amount += 1
+
+	def build(self) -> List[RedPianoTrack]:
+		for track, item, length in zip(self.tracks, self.__items, self.__lengths):
+			track.append_run(item, length)
+		self.__lengths = [0] * len(self.tracks)
+		return self.tracks
+
+
+def extend_tracks(tracks: List[RedPianoTrack], new_tracks: List[RedPianoTrack], offset: int, length: int):
+	"""
+	Append the red tracks of the following segments, e.g. built for a part of the segments, to the red tracks.
+	New red tracks are filled with empty items for all previous segments, and missing ones for the following segments
+	:param offset: amount of the previous segments
+	:param length: amount of the following segments
+	"""
+	while len(tracks) < len(new_tracks):
+		tracks.append(RedPianoTrack.empty(offset))
+	for track, new_track in zip(tracks, new_tracks):
+		track.extend(new_track)
+	for track in tracks[len(new_tracks):]:
+		track.append_run(RedPianoTrackItem.empty(), length)
+
+
+class RedTrackAllocator:
+	"""
+	Distributes the required items of each segment into red tracks
+
+	The amount of red tracks is the max amount of required items in a segment. A red track needs a new item stack
+	whenever the symbol or the time mark of its item changes, so the items of each segment are assigned to the tracks
+	to maximize the total amount of kept symbols and time marks, which is solved exactly as a matching between the
+	previous items and the required items
+	"""
+	def __init__(self, optimize: bool = True):
+		self.optimize = optimize
+		self.last_items: List[RedPianoTrackItem] = []
+
+	def allocate(self, required_items: List[RedPianoTrackItem]) -> List[RedPianoTrackItem]:
+		"""
+		:return: the item of each red track in this segment. New red tracks are appended at the end,
+		and they are considered to be filled with empty items for all previous segments
+		"""
+		track_amount = max(len(self.last_items), len(required_items))
+		while len(self.last_items) < track_amount:
+			self.last_items.append(RedPianoTrackItem.empty())
+		items = list(required_items) + [RedPianoTrackItem.empty()] * (track_amount - len(required_items))
+		if self.optimize and items != self.last_items:
+			items = self.__match(self.last_items, items)
+		self.last_items = items
+		return items
+
+	@classmethod
+	def __match(cls, last_items: List[RedPianoTrackItem], items: List[RedPianoTrackItem]) -> List[RedPianoTrackItem]:
+		"""
+		:return: the items ordered by track, with the max amount of symbols and time marks kept from the previous items
+		"""
+		result: List[Optional[RedPianoTrackItem]] = [None] * len(last_items)
+		# keeping the whole item is always part of a best assignment: if the track of the item and the track taking
+		# it swapped their items, the symbols and time marks kept by them could only increase
+		free_tracks: Dict[RedPianoTrackItem, List[int]] = {}
+		for i, prev in enumerate(last_items):
+			free_tracks.setdefault(prev, []).append(i)
+		rest: List[RedPianoTrackItem] = []
+		for item in items:
+			tracks = free_tracks.get(item)
+			if tracks:
+				result[tracks.pop(0)] = item
+			else:
+				rest.append(item)
+		if len(rest) == 0:
+			return result
+		rest_tracks = [i for i in range(len(last_items)) if result[i] is None]
+
+		# the rest items keep either the symbol or the time mark of a track, so the best assignment is a maximum
+		# matching between them, found with augmenting paths
+		rest_prev = [(i, last_items[i].symbol, last_items[i].time_mark) for i in rest_tracks]
+		candidates: List[List[int]] = []
+		for item in rest:
+			symbol, time_mark = item.symbol, item.time_mark
+			candidates.append([i for i, prev_symbol, prev_time_mark in rest_prev if prev_symbol is symbol or prev_time_mark == time_mark])
+		owner: Dict[int, int] = {}  # track -> index of its item in rest
+
+		def augment(j: int, visited: set) -> bool:
+			for i in candidates[j]:
+				if i not in visited:
+					visited.add(i)
+					if i not in owner or augment(owner[i], visited):
+						owner[i] = j
+						return True
+			return False
+
+		for j in range(len(rest)):
+			if len(candidates[j]) > 0:
+				augment(j, set())
+		matched = set(owner.values())
+		unmatched = iter([item for j, item in enumerate(rest) if j not in matched])
+		for i in rest_tracks:
+			result[i] = rest[owner[i]] if i in owner else next(unmatched)
+		return result
@@ -0,0 +1,159 @@
+"""
+Watch mode: keep the process alive and recompile the sheet files as soon as they are saved
+"""
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import select
+import struct
+import sys
+import time
+from typing import List, Tuple, Optional, Dict
+
+from batch import compile_sheet_file, print_batch_result
+from compiler import CompileOptions
+
+POLL_INTERVAL = 0.2  # seconds between two stat checks when polling
+INOTIFY_RECHECK_INTERVAL = 1.0  # seconds between two stat checks when no inotify event arrives, in case an event is missed
+DEBOUNCE_DELAY = 0.05  # editors may write a file in multiple steps, wait for the rest of them
+
+# see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+_INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+	"""
+	A minimal inotify binding watching directories, only used as a wake-up signal
+	"""
+	def __init__(self, directories: List[str]):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+		for directory in directories:
+			if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+				os.close(self.fd)
+				raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for {}'.format(directory))
+
+	def wait(self, timeout: float) -> bool:
+		"""
+		:return: if any event arrived in time. The events are drained
+		"""
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if len(readable) == 0:
+			return False
+		time.sleep(DEBOUNCE_DELAY)
+		try:
+			while len(os.read(self.fd, 64 * _INOTIFY_EVENT_HEADER.size)) > 0:
+				pass
+		except BlockingIOError:
+			pass
+		return True
+
+	def close(self):
+		os.close(self.fd)
+
+
+class SheetWatcher:
+	"""
+	Detects content changes of the given files. Uses inotify on linux, and polls the file stats elsewhere
+	"""
+	def __init__(self, paths: List[str], use_inotify: bool = True):
+		self.paths = paths
+		self.__signatures: Dict[str, Optional[Tuple[int, int]]] = {path: self.__get_signature(path) for path in paths}
+		self.__digests: Dict[str, Optional[str]] = {}
+		self.__inotify: Optional[_Inotify] = None
+		if use_inotify and sys.platform.startswith('linux'):
+			try:
+				self.__inotify = _Inotify(sorted(set(os.path.dirname(os.path.abspath(path)) for path in paths)))
+			except (OSError, AttributeError, TypeError):
+				# no usable libc, fallback to polling
+				self.__inotify = None
+
+	@property
+	def backend(self) -> str:
+		return 'inotify' if self.__inotify is not None else 'polling'
+
+	@staticmethod
+	def __get_signature(path: str) -> Optional[Tuple[int, int]]:
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		return stat.st_mtime_ns, stat.st_size
+
+	@staticmethod
+	def __get_digest(path: str) -> Optional[str]:
+		try:
+			with open(path, 'rb') as f:
+				return hashlib.sha256(f.read()).hexdigest()
+		except OSError:
+			return None
+
+	def mark_compiled(self, path: str):
+		"""
+		Remember the current content of the file, so saving it without modification does not trigger a recompile
+		"""
+		self.__digests[path] = self.__get_digest(path)
+
+	def wait_changes(self) -> List[str]:
+		"""
+		Block until the content of some files changes
+		:return: the changed files, in the order of the given paths
+		"""
+		while True:
+			if self.__inotify is not None:
+				self.__inotify.wait(INOTIFY_RECHECK_INTERVAL)
+			else:
+				time.sleep(POLL_INTERVAL)
+			changed = []
+			for path in self.paths:
+				signature = self.__get_signature(path)
+				if signature != self.__signatures[path]:
+					self.__signatures[path] = signature
+					if signature is not None and self.__get_digest(path) != self.__digests.get(path):
+						changed.append(path)
+			if len(changed) > 0:
+				return changed
+
+	def close(self):
+		if self.__inotify is not None:
+			self.__inotify.close()
+			self.__inotify = None
+
+
+def run_watch(files: List[Tuple[str, str]], options: CompileOptions = CompileOptions()):
+	"""
+	Compile the sheet files, then recompile each of them whenever it changes, until ctrl+c
+	:param files: (input path, output path) of each sheet
+	"""
+	output_paths = dict(files)
+	watcher = SheetWatcher([input_path for input_path, _ in files])
+
+	def compile_file(input_path: str):
+		watcher.mark_compiled(input_path)
+		result = compile_sheet_file(input_path, output_paths[input_path], options)
+		print('[{}] '.format(time.strftime('%H:%M:%S')), end='')
+		print_batch_result(result)
+		sys.stdout.flush()
+
+	print('监视{}个输入文件的修改 ({})，按Ctrl+C退出'.format(len(files), watcher.backend))
+	try:
+		for input_path, _ in files:
+			if os.path.isfile(input_path):
+				compile_file(input_path)
+			else:
+				print('输入文件"{}"未找到，将在其被创建后编译'.format(input_path))
+		while True:
+			for input_path in watcher.wait_changes():
+				compile_file(input_path)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		watcher.close()
+	print('已退出监视模式')